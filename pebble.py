@@ -8,7 +8,7 @@ import pebble.PblAnalytics as PblAnalytics
 
 # Catch any missing python dependencies so we can send an event to analytics
 try:
-    import pebble as libpebble
+    import pebble.pebble as libpebble
     from pebble.PblProjectCreator   import (PblProjectCreator, 
                                             InvalidProjectException, 
                                             OutdatedProjectException)
@@ -22,9 +22,11 @@ except Exception as e:
     raise
 
 class PbSDKShell:
-    commands = []
 
     def __init__(self):
+        self.commands = []
+        self.parser = None
+
         self.commands.append(PblProjectCreator())
         self.commands.append(PblProjectConverter())
         self.commands.append(PblBuildCommand())
@@ -42,6 +44,8 @@ class PbSDKShell:
         self.commands.append(PblScreenshotCommand())
         self.commands.append(PblLaunchApp())
 
+        self.commands_by_name = dict((command.name, command) for command in self.commands)
+
     def _get_version(self):
         try:
             from pebble.VersionGenerated import SDK_VERSION
@@ -50,7 +54,12 @@ class PbSDKShell:
             return "'Development'"
         
 
-    def main(self):
+    def build_parser(self):
+        """ Build the argument parser once and reuse it on later calls """
+
+        if self.parser is not None:
+            return self.parser
+
         parser = argparse.ArgumentParser(description = 'Pebble SDK Shell')
         parser.add_argument('--debug', action="store_true", 
                             help="Enable debugging output")
@@ -61,7 +70,12 @@ class PbSDKShell:
         for command in self.commands:
             subparser = subparsers.add_parser(command.name, help = command.help)
             command.configure_subparser(subparser)
-        args = parser.parse_args()
+
+        self.parser = parser
+        return parser
+
+    def main(self):
+        args = self.build_parser().parse_args()
 
         log_level = logging.INFO
         if args.debug:
@@ -74,7 +88,7 @@ class PbSDKShell:
 
     def run_action(self, action, args):
         # Find the extension that was called
-        command = [x for x in self.commands if x.name == args.command][0]
+        command = self.commands_by_name[args.command]
 
         try:
             retval = command.run(args)
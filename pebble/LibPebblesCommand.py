@@ -1,9 +1,10 @@
-import fnmatch
 import logging
 import os
-import sh
-import subprocess
+import random
+import signal
+import threading
 import time
+import uuid
 
 import pebble as libpebble
 
@@ -12,6 +13,10 @@ import PblAnalytics
 
 PEBBLE_PHONE_ENVVAR='PEBBLE_PHONE'
 PEBBLE_ID_ENVVAR='PEBBLE_ID'
+PEBBLE_REMOTE_POLL_ENVVAR='PEBBLE_REMOTE_POLL'
+
+CONNECT_MAX_ATTEMPTS = 5
+CONNECT_MAX_DELAY = 8
 
 class ConfigurationException(Exception):
     pass
@@ -44,12 +49,30 @@ class LibPebbleCommand(PblCommand):
             raise ConfigurationException("Argument --phone or --pebble_id is required (Or set a PEBBLE_{PHONE,ID} environment variable)")
         self.pebble = libpebble.Pebble()
         self.pebble.set_print_pbl_logs(args.verbose)
+        self.connect(args)
 
-        if args.phone:
-            self.pebble.connect_via_websocket(args.phone)
+    def connect(self, args):
+        """
+        Connect to the phone and/or watch, retrying with a jittered
+        exponential backoff so that a slow adapter doesn't fail the command.
+        """
 
-        if args.pebble_id:
-            self.pebble.connect_via_serial(args.pebble_id)
+        delay = 0.5
+        for attempt in range(1, CONNECT_MAX_ATTEMPTS + 1):
+            try:
+                if args.phone:
+                    self.pebble.connect_via_websocket(args.phone)
+
+                if args.pebble_id:
+                    self.pebble.connect_via_serial(args.pebble_id)
+                return
+            except (libpebble.PebbleError, IOError) as e:
+                if attempt == CONNECT_MAX_ATTEMPTS:
+                    raise libpebble.PebbleConnectError(args.pebble_id or args.phone,
+                            "Could not connect to Pebble: %s" % e)
+                logging.debug("Connection attempt %d failed (%s), retrying in %.1fs" % (attempt, e, delay))
+                time.sleep(delay + random.uniform(0, delay * 0.25))
+                delay = min(delay * 2, CONNECT_MAX_DELAY)
 
     def tail(self, interactive=False, skip_enable_app_log=False):
         if not skip_enable_app_log:
@@ -67,20 +90,24 @@ class LibPebbleCommand(PblCommand):
             start_repl(self.pebble)
         else:
             logging.info('Displaying logs ... Ctrl-C to interrupt.')
+            # Logs are printed by the reader thread as they arrive, so just
+            # wait for the user to interrupt us. The timeout keeps the wait
+            # interruptible by signals on Python 2.
+            interrupted = threading.Event()
+            previous_handler = signal.signal(signal.SIGINT,
+                                    lambda signum, frame: interrupted.set())
             try:
-                while True:
-                    time.sleep(1)
-            except KeyboardInterrupt:
-                print "\n"
+                while not interrupted.wait(1):
+                    pass
+            finally:
+                signal.signal(signal.SIGINT, previous_handler)
+            print "\n"
         self.pebble.app_log_disable()
 
 class PblPingCommand(LibPebbleCommand):
     name = 'ping'
     help = 'Ping your Pebble project to your watch'
 
-    def configure_subparser(self, parser):
-        LibPebbleCommand.configure_subparser(self, parser)
-
     def run(self, args):
         LibPebbleCommand.run(self, args)
         self.pebble.ping(cookie=0xDEADBEEF)
@@ -99,12 +126,13 @@ class PblInstallCommand(LibPebbleCommand):
         parser.add_argument('--logs', action='store_true', help='Display logs after installing the app')
 
     def run(self, args):
-        LibPebbleCommand.run(self, args)
-
+        # Check the bundle before spending time connecting to the watch
         if not os.path.exists(args.pbw_path):
             logging.error("Could not find pbw <{}> for install.".format(args.pbw_path))
             return 1
 
+        LibPebbleCommand.run(self, args)
+
         self.pebble.app_log_enable()
 
         success = self.pebble.install_app(args.pbw_path, args.launch)
@@ -125,12 +153,12 @@ class PblInstallFWCommand(LibPebbleCommand):
         parser.add_argument('pbz_path', type=str, help='Path to the pbz to install')
 
     def run(self, args):
-        LibPebbleCommand.run(self, args)
-
         if not os.path.exists(args.pbz_path):
             logging.error("Could not find pbz <{}> for install.".format(args.pbz_path))
             return 1
 
+        LibPebbleCommand.run(self, args)
+
         self.pebble.install_firmware(args.pbz_path)
         time.sleep(5)
         logging.info('Resetting to apply firmware update...')
@@ -140,63 +168,123 @@ class PblListCommand(LibPebbleCommand):
     name = 'list'
     help = 'List the apps installed on your watch'
 
-    def configure_subparser(self, parser):
-        LibPebbleCommand.configure_subparser(self, parser)
-
     def run(self, args):
         LibPebbleCommand.run(self, args)
 
         try:
             response = self.pebble.get_appbank_status()
-            apps = response['apps']
-            if len(apps) == 0:
-                logging.info("No apps installed.")
-            for app in apps:
-                logging.info('[{}] {}'.format(app['index'], app['name']))
-        except:
+        except libpebble.PebbleError:
             logging.error("Error getting apps list.")
             return 1
 
+        apps = response['apps']
+        if len(apps) == 0:
+            logging.info("No apps installed.")
+        for app in apps:
+            logging.info('[{}] {}'.format(app['index'], app['name']))
+
 class PblRemoteCommand(LibPebbleCommand):
     name = 'remote'
     help = 'Use Pebble\'s music app as a remote control for a local application'
 
+    control_events = {
+        "PLAYPAUSE": "playpause",
+        "PREVIOUS": "previous track",
+        "NEXT": "next track"
+    }
+
     def configure_subparser(self, parser):
         LibPebbleCommand.configure_subparser(self, parser)
         parser.add_argument('app_name', type=str, help='Local application name to control')
+        parser.add_argument('--poll-interval', type=float, default=os.getenv(PEBBLE_REMOTE_POLL_ENVVAR, '15'),
+                help='Seconds between checks for a track change - Can also be provided through PEBBLE_REMOTE_POLL environment variable.')
 
     def do_oscacript(self, command):
-        cmd = "osascript -e 'tell application \""+self.args.app_name+"\" to "+command+"'"
+        # NSAppleScript may only be used from the main thread; music control
+        # events arrive on the reader thread, so those go through osascript
+        if self.NSAppleScript and threading.current_thread() is self.main_thread:
+            return self.do_compiled_applescript(command)
+
+        import subprocess
+        script = 'tell application "%s" to %s' % (self.args.app_name, command)
         try:
-            return subprocess.check_output(cmd, shell=True)
+            return subprocess.check_output(["osascript", "-e", script])
         except subprocess.CalledProcessError:
             print "Failed to send message to "+self.args.app_name+", is it running?"
             return False
 
-    def music_control_handler(self, endpoint, resp):
-        control_events = {
-            "PLAYPAUSE": "playpause",
-            "PREVIOUS": "previous track",
-            "NEXT": "next track"
-        }
-        if resp in control_events:
-            self.do_oscacript(control_events[resp])
-        elif resp == 'GET_NOW_PLAYING':
-            self.update_metadata()
+    def do_compiled_applescript(self, command):
+        """
+        Run a command through NSAppleScript, compiling each distinct command
+        only once instead of spawning osascript for every call.
+        """
+
+        script = self.compiled_scripts.get(command)
+        if script is None:
+            source = 'tell application "%s" to %s' % (self.args.app_name, command)
+            script = self.NSAppleScript.alloc().initWithSource_(source)
+            script.compileAndReturnError_(None)
+            self.compiled_scripts[command] = script
+
+        result, error = script.executeAndReturnError_(None)
+        if result is None:
+            print "Failed to send message to "+self.args.app_name+", is it running?"
+            return False
 
-    def update_metadata(self):
-        artist = self.do_oscacript("artist of current track as string")
-        title = self.do_oscacript("name of current track as string")
-        album = self.do_oscacript("album of current track as string")
+        value = result.stringValue()
+        return value.encode('utf-8') if value else ''
 
-        if not artist or not title or not album:
-            self.pebble.set_nowplaying_metadata("No Music Found", "", "")
+    def music_control_handler(self, endpoint, resp):
+        command = self.control_events.get(resp)
+        if command:
+            self.do_oscacript(command)
+        elif resp == 'GET_NOW_PLAYING':
+            self.update_metadata(force=True)
+
+    def get_current_track(self):
+        """
+        Fetch (title, album, artist) of the current track with a single
+        AppleScript call, or None if the application could not be queried.
+        """
+
+        track = self.do_oscacript("return (name of current track as string) & tab & "
+                                  "(album of current track as string) & tab & "
+                                  "(artist of current track as string)")
+        if not track:
+            return None
+
+        fields = track.rstrip('\n').split('\t')
+        if len(fields) != 3:
+            return None
+        return tuple(fields)
+
+    def update_metadata(self, force=False):
+        track = self.get_current_track()
+
+        if not track or not all(track):
+            metadata = ("No Music Found", "", "")
         else:
-            self.pebble.set_nowplaying_metadata(title, album, artist)
+            metadata = track
+
+        # Only bother the watch when the track changed or it asked for it
+        if force or metadata != self.last_metadata:
+            self.pebble.set_nowplaying_metadata(*metadata)
+            self.last_metadata = metadata
 
     def run(self, args):
         LibPebbleCommand.run(self, args)
         self.args = args
+        self.last_metadata = None
+
+        # PyObjC ships with the system python on OS X; without it we fall
+        # back to shelling out to osascript.
+        try:
+            from Foundation import NSAppleScript
+            self.NSAppleScript = NSAppleScript
+        except ImportError:
+            self.NSAppleScript = None
+        self.compiled_scripts = {}
+        self.main_thread = threading.current_thread()
 
         self.pebble.register_endpoint("MUSIC_CONTROL", self.music_control_handler)
 
@@ -204,7 +292,7 @@ class PblRemoteCommand(LibPebbleCommand):
         try:
             while True:
                 self.update_metadata()
-                time.sleep(5)
+                time.sleep(args.poll_interval)
         except KeyboardInterrupt:
             return
 
@@ -214,19 +302,37 @@ class PblRemoveCommand(LibPebbleCommand):
 
     def configure_subparser(self, parser):
         LibPebbleCommand.configure_subparser(self, parser)
-        parser.add_argument('bank_id', type=int, help="The bank id of the app to remove (between 1 and 8)")
+        parser.add_argument('bank_id', type=str, help="The bank id of the app to remove (between 1 and 8), or its hex UUID")
 
     def run(self, args):
+        app_uuid = None
+        try:
+            bank_id = int(args.bank_id)
+        except ValueError:
+            try:
+                app_uuid = uuid.UUID(args.bank_id).bytes
+            except ValueError:
+                raise ConfigurationException("'%s' is neither a bank id nor an app UUID" % args.bank_id)
+
         LibPebbleCommand.run(self, args)
 
-        for app in self.pebble.get_appbank_status()['apps']:
-            if app['index'] == args.bank_id:
-                self.pebble.remove_app(app["id"], app["index"])
-                logging.info("App removed")
-                return 0
+        if app_uuid is not None:
+            # Removing by UUID doesn't need the app bank listing at all
+            self.pebble.remove_app_by_uuid(app_uuid, uuid_is_string=False)
+            logging.info("App removed")
+            return 0
 
-        logging.info("No app found in bank %u" % args.bank_id)
-        return 1
+        apps = self.pebble.get_appbank_status()['apps']
+        apps_by_index = {app['index']: app for app in apps}
+
+        app = apps_by_index.get(bank_id)
+        if app is None:
+            logging.info("No app found in bank %u" % bank_id)
+            return 1
+
+        self.pebble.remove_app(app["id"], app["index"])
+        logging.info("App removed")
+        return 0
 
 class PblCurrentAppCommand(LibPebbleCommand):
     name = 'current'
@@ -301,9 +407,6 @@ class PblLogsCommand(LibPebbleCommand):
     name = 'logs'
     help = 'Continuously displays logs from the watch'
 
-    def configure_subparser(self, parser):
-        LibPebbleCommand.configure_subparser(self, parser)
-
     def run(self, args):
         LibPebbleCommand.run(self, args)
         self.tail()
@@ -4,9 +4,12 @@ import multiprocessing
 import os
 import Queue
 import re
+import select
 import socket
 from multiprocessing import Process
-from struct import unpack
+from struct import Struct
+
+MESSAGE_HEADER_STRUCT = Struct("!HH") # length, endpoint
 
 class LightBluePebbleError(Exception):
     def __init__(self, id, message):
@@ -19,18 +22,21 @@ class LightBluePebbleError(Exception):
 class LightBluePebble(object):
     """ a wrapper for LightBlue that provides Serial-style read, write and close"""
 
+    # longest the connection process sleeps before rechecking for teardown
+    poll_interval = 0.5
+
     def __init__(self, id, should_pair, debug_protocol=False, connection_process_timeout=60):
 
         self.mac_address = id
         self.debug_protocol = debug_protocol
         self.should_pair = should_pair
 
-        manager = multiprocessing.Manager()
-        self.send_queue = manager.Queue()
-        self.rec_queue = manager.Queue()
+        # plain queues talk over a pipe directly; a Manager would add a
+        # server process and an extra pickling hop to every message
+        self.send_reader, self.send_writer = multiprocessing.Pipe(duplex=False)
+        self.rec_queue = multiprocessing.Queue()
 
         self.bt_teardown = multiprocessing.Event()
-        self.bt_message_sent = multiprocessing.Event()
         self.bt_connected = multiprocessing.Event()
 
         self.bt_socket_proc = Process(target=self.run)
@@ -45,8 +51,7 @@ class LightBluePebble(object):
     def write(self, message):
         """ send a message to the LightBlue processs"""
         try:
-            self.send_queue.put(message)
-            self.bt_message_sent.wait()
+            self.send_writer.send(message)
         except:
             self.bt_teardown.set()
             if self.debug_protocol:
@@ -125,34 +130,52 @@ class LightBluePebble(object):
         # Tell our parent that we have a pebble connected now
         self.bt_connected.set()
 
+        # sleep until there is something to send or receive rather than
+        # spinning; not every LightBlue backend gives the socket a descriptor
+        # to wait on, in which case only the send side can be waited for
+        try:
+            self._bts.fileno()
+            can_select = True
+        except (AttributeError, NotImplementedError, socket.error):
+            can_select = False
+
         send_data = e = None
         while not self.bt_teardown.is_set():
-            # send anything in the send queue
-            try:
-                send_data = self.send_queue.get_nowait()
-                self._bts.send(send_data)
-                if self.debug_protocol:
-                    log.debug("LightBlue Send: %r" % send_data)
-                self.bt_message_sent.set()
-            except Queue.Empty:
-                pass
-            except (IOError, EOFError):
-                self.bt_teardown.set()
-                e = "Queue Error while sending data"
+            if can_select:
+                ready = select.select([self._bts, self.send_reader], [], [], self.poll_interval)[0]
+                send_ready = self.send_reader in ready
+                recv_ready = self._bts in ready
+            else:
+                send_ready = self.send_reader.poll(0.005)
+                recv_ready = True
+
+            # send anything waiting in the send pipe
+            if send_ready:
+                try:
+                    send_data = self.send_reader.recv()
+                    self._bts.send(send_data)
+                    if self.debug_protocol:
+                        log.debug("LightBlue Send: %r" % send_data)
+                except (IOError, EOFError):
+                    self.bt_teardown.set()
+                    e = "Queue Error while sending data"
 
             # if anything is received relay it back
             rec_data = None
-            try:
-                rec_data = self._bts.recv(4)
-            except (socket.timeout, socket.error):
-                # Exception raised from timing out on nonblocking
-                pass
+            if recv_ready:
+                try:
+                    rec_data = self._bts.recv(4)
+                except (socket.timeout, socket.error):
+                    # Exception raised from timing out on nonblocking
+                    pass
 
             if (rec_data is not None) and (len(rec_data) == 4):
                 # check the Stream Multiplexing Layer message and get the length of the data to read
-                size, endpoint = unpack("!HH", rec_data)
+                size, endpoint = MESSAGE_HEADER_STRUCT.unpack(rec_data)
                 resp = ''
                 while len(resp) < size:
+                    if can_select:
+                        select.select([self._bts], [], [], self.poll_interval)
                     try:
                         resp += self._bts.recv(size-len(resp))
                     except (socket.timeout, socket.error):
@@ -165,7 +188,7 @@ class LightBluePebble(object):
                     self.rec_queue.put((endpoint, resp, rec_data))
 
                 except (IOError, EOFError):
-                    self.BT_TEARDOWN.set()
+                    self.bt_teardown.set()
                     e = "Queue Error while recieving data"
                     pass
                 if self.debug_protocol:
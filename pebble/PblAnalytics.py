@@ -1,16 +1,57 @@
 #!/usr/bin/env python
 
 
-from urllib2 import urlopen, Request
-from urllib import urlencode
-import datetime
+# The network, platform and uuid modules are imported where they are used,
+#  so that a run with analytics turned off never loads them
+from Queue import Queue, Empty, Full
+import atexit
 import time
 import logging
 import os
-import platform
-import uuid
-import pprint
-import subprocess
+import threading
+
+ANALYTICS_HOST = 'www.google-analytics.com'
+COLLECT_PATH = '/collect'   # takes a single hit
+BATCH_PATH = '/batch'       # takes up to BATCH_SIZE hits, one per line
+BATCH_SIZE = 20
+
+SEND_TIMEOUT = 2.0      # seconds the background sender waits on the server
+FLUSH_TIMEOUT = 1.0     # seconds we hold up interpreter exit for pending events
+QUEUE_SIZE = 64         # events buffered before we start dropping them
+DISABLE_PERIOD = 24 * 60 * 60   # seconds we stay quiet after a failed send
+
+# Encoded events waiting to be sent by the background thread
+_queue = Queue(maxsize=QUEUE_SIZE)
+
+
+####################################################################
+def _utf8(value):
+    """ Return value as a utf-8 encoded str if it's a string """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, basestring):
+        return unicode(value, errors='replace').encode('utf-8')
+    return value
+
+
+####################################################################
+def _flush_queue(timeout=FLUSH_TIMEOUT):
+    """ Wait (briefly) for the background thread to send queued events """
+
+    deadline = time.time() + timeout
+    with _queue.all_tasks_done:
+        while _queue.unfinished_tasks:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            _queue.all_tasks_done.wait(remaining)
+
+
+####################################################################
+def _read_file(path):
+    """ Return the contents of path, closing it straight away """
+    with open(path) as fd:
+        return fd.read()
 
 
 ####################################################################
@@ -20,7 +61,7 @@ def _running_in_vm():
     try:
         drv_name = "/proc/scsi/scsi"
         if os.path.exists(drv_name):
-            contents = open(drv_name).read()
+            contents = _read_file(drv_name)
             if "VBOX" in contents or "VMware" in contents:
                 return True
     except:
@@ -36,6 +77,7 @@ class _Analytics(object):
     analytics module """
     
     _instance = None
+    _sender = None
 
     @classmethod
     def get(cls):
@@ -53,7 +95,23 @@ class _Analytics(object):
         """
         
         self.tracking_id = 'UA-30638158-7'
-        self.endpoint = 'https://www.google-analytics.com/collect'
+        self._dropped_events = 0
+
+        # Should we track analytics? If the user has opted out there is
+        #  nothing else to set up, not even the client id.
+        sdkPath = os.path.normpath(os.path.join(os.path.dirname(__file__), 
+                                                '..', '..'))
+        dntFile = os.path.join(sdkPath, "NO_TRACKING")
+        self._opted_out = ('PEBBLE_NO_ANALYTICS' in os.environ or
+                           os.path.exists(dntFile))
+        self.do_not_track = self._opted_out
+        if self._opted_out:
+            logging.debug("Analytics collection disabled by the user")
+            return
+
+        from urllib import urlencode
+        import platform
+        import uuid
         
         cur_sdk_version = self._get_sdk_version()
         self.os_str = platform.platform()
@@ -69,44 +127,60 @@ class _Analytics(object):
         settingsDir = os.path.join(homeDir, ".pebble")
         if not os.path.exists(settingsDir):
             os.makedirs(settingsDir)
+        clientIdFile = os.path.join(settingsDir, "client_id")
+        sdkVersionFile = os.path.join(settingsDir, "sdk_version")
+        self._disabled_until_file = os.path.join(settingsDir,
+                                                 "analytics_disabled_until")
             
         # Get (and create if necessary) the client id
         try:
-            clientId = open(os.path.join(settingsDir, "client_id")).read()
+            clientId = _read_file(clientIdFile)
         except:
             clientId = None
         if clientId is None:
             clientId = str(uuid.uuid4())
-            with open(os.path.join(settingsDir, "client_id"), 'w') as fd:
+            with open(clientIdFile, 'w') as fd:
                 fd.write(clientId)
 
         self.client_id = clientId
-            
-        # Should we track analytics?
-        sdkPath = os.path.normpath(os.path.join(os.path.dirname(__file__), 
-                                                '..', '..'))
-        dntFile = os.path.join(sdkPath, "NO_TRACKING")
-        self.do_not_track = os.path.exists(dntFile)
 
-        # Don't track if internet connection is down
+        # The parts of each event that don't change during the session. See
+        #  post_event() for why cn, cs and ck hold what they do.
+        # TODO: Set cn to PEBBLE-INTERNAL or PEBBLE-AUTOMATED as appropriate
+        self._base_params = [('v', 1),
+                             ('tid', _utf8(self.tracking_id)),
+                             ('cid', _utf8(self.client_id)),
+                             ('cn', _utf8(self.os_str)),
+                             ('cs', _utf8(self.client_id)),
+                             ('ck', _utf8(platform.python_version())),
+                             ('t', 'event')]
+        self._body_prefix = urlencode(self._base_params) + '&'
+
+        # Don't track if a recent session couldn't reach the server. We
+        #  don't probe for connectivity here; the first failed send turns
+        #  tracking off instead.
         if not self.do_not_track:
             try:
-                urlopen(self.endpoint, timeout=0.1)
+                disabled_until = float(_read_file(self._disabled_until_file))
             except:
+                disabled_until = 0
+            if time.time() < disabled_until:
                 self.do_not_track = True
-                logging.debug("Analytics collection disabled due to lack of"
+                logging.debug("Analytics collection disabled due to lack of "
                               "internet connectivity")
             
         if self.do_not_track:
             return
+
+        self._start_sender()
         
         # Detect if this is a new install and send an event if so
         try:
-            cached_version = open(os.path.join(settingsDir, "sdk_version")).read()
+            cached_version = _read_file(sdkVersionFile)
         except:
             cached_version = None
         if not cached_version or cached_version != cur_sdk_version:
-            with open(os.path.join(settingsDir, "sdk_version"), 'w') as fd:
+            with open(sdkVersionFile, 'w') as fd:
                 fd.write(cur_sdk_version)
             if cached_version is None:
                 action = 'firstTime'
@@ -117,6 +191,82 @@ class _Analytics(object):
             
         
         
+    ####################################################################
+    def _start_sender(self):
+        """ Start the thread that posts queued events to the server, so
+        that the network round trip stays off the command's own thread """
+        if _Analytics._sender is not None:
+            return
+        _Analytics._sender = threading.Thread(target=self._send_worker)
+        _Analytics._sender.daemon = True
+        _Analytics._sender.start()
+        atexit.register(_flush_queue)
+
+
+    ####################################################################
+    def _send_worker(self):
+        """ Body of the sender thread. Whatever has queued up while the
+        previous request was in flight goes out together in one batch, over
+        a connection we keep open between batches """
+        conn = None
+        while True:
+            bodies = [_queue.get()]
+            while len(bodies) < BATCH_SIZE:
+                try:
+                    bodies.append(_queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                if not self.do_not_track:
+                    path = BATCH_PATH if len(bodies) > 1 else COLLECT_PATH
+                    conn = self._post(conn, path, '\n'.join(bodies))
+            except Exception as e:
+                conn = None
+                # Turn off tracking so we don't keep trying for the rest
+                #  of this session, or in the sessions that follow soon
+                #  after it.
+                self.do_not_track = True
+                try:
+                    with open(self._disabled_until_file, 'w') as fd:
+                        fd.write(str(time.time() + DISABLE_PERIOD))
+                except:
+                    pass
+                logging.debug("Exception occurred sending analytics: %s" %
+                              str(e))
+                logging.debug("Disabling analytics due to intermittent "
+                              "connectivity")
+            finally:
+                for _ in bodies:
+                    _queue.task_done()
+
+
+    ####################################################################
+    def _post(self, conn, path, body):
+        """ POST body to path over conn, opening a connection if conn is
+        None, and return the connection to use for the next request. If the
+        server has dropped a kept-alive connection in the meantime we open a
+        new one and retry once """
+        import httplib
+        import socket
+
+        reused = conn is not None
+        if not reused:
+            conn = httplib.HTTPSConnection(ANALYTICS_HOST,
+                                           timeout=SEND_TIMEOUT)
+        try:
+            conn.request('POST', path, body,
+                  {'User-Agent': self.user_agent,
+                   'Content-Type': 'application/x-www-form-urlencoded',
+                   'Connection': 'keep-alive'})
+            conn.getresponse().read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            return self._post(None, path, body)
+        return conn
+
+
     ####################################################################
     def _get_sdk_version(self):
         """ Get the SDK version """
@@ -154,35 +304,16 @@ class _Analytics(object):
         value: The optional event value (integer)
         """
 
-    
-        data = {}
-        data['v'] = 1
-        data['tid'] = self.tracking_id
-        data['cid'] = self.client_id
-        
-        # TODO: Set this to PEBBLE-INTERNAL or PEBBLE-AUTOMATED as appropriate
-        data['cn'] = self.os_str
-        data['cs'] = self.client_id
-        data['ck'] = platform.python_version()
-        
-        # Generate an event
-        data['t'] = 'event'
-        data['ec'] = category
-        data['ea'] = action
-        data['el'] = label
-        if value:
-            data['ev'] = value
-        else:
-            data['ev'] = 0
-            
-        # Convert all strings to utf-8
-        for key,value in data.items():
-            if isinstance(value, basestring):
-                if isinstance(value, unicode):
-                    data[key] = value.encode('utf-8')
-                else:
-                    data[key] = unicode(value, errors='replace').encode('utf-8')
 
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if self.do_not_track and (self._opted_out or not debug):
+            return
+
+        # Generate an event; only its own fields need converting to utf-8
+        event = [('ec', _utf8(category)),
+                 ('ea', _utf8(action)),
+                 ('el', _utf8(label)),
+                 ('ev', _utf8(value) if value else 0)]
                 
         headers = {
                 'User-Agent': self.user_agent
@@ -194,32 +325,26 @@ class _Analytics(object):
         if self.do_not_track:
             logging.debug("Not sending analytics - tracking disabled") 
         else:
-            request = Request(self.endpoint,
-                          data=urlencode(data),
-                          headers = headers)
-        
+            # The actual send happens on the sender thread
+            from urllib import urlencode
             try:
-                urlopen(request, timeout=0.1)
-            except Exception as e:
-                # Turn off tracking so we don't incur a delay on subsequent
-                #  events in this same session. 
-                self.do_not_track = True
-                logging.debug("Exception occurred sending analytics: %s" %
-                              str(e))
-                logging.debug("Disabling analytics due to intermittent "
-                              "connectivity")
+                _queue.put_nowait(self._body_prefix + urlencode(event))
+            except Full:
+                if not self._dropped_events:
+                    logging.debug("Analytics events produced faster than "
+                                  "they can be sent, dropping some")
+                self._dropped_events += 1
         
         # Debugging output?
-        dumpDict = dict(data)
-        for key in ['ec', 'ea', 'el', 'ev']:
-            dumpDict.pop(key, None)
+        if not debug:
+            return
         logging.debug("[Analytics] header: %s, data: %s"  
                       "\ncategory: %s"  
                       "\naction: %s"    
                       "\nlabel: %s"     
                       "\nvalue: %s" % 
-                      (headers, str(dumpDict), 
-                       data['ec'], data['ea'], data['el'], data['ev']))
+                      (headers, str(dict(self._base_params)), 
+                       event[0][1], event[1][1], event[2][1], event[3][1]))
                       
     
 
@@ -298,9 +423,10 @@ def code_line_count_evt(uuid, c_line_count, js_line_count):
     c_line_count: number of lines of C source code
     js_line_count: number of lines of javascript source code
     """
-    _Analytics.get().post_event(category='appCode', action='cLineCount', 
+    analytics = _Analytics.get()
+    analytics.post_event(category='appCode', action='cLineCount', 
                label=uuid, value = c_line_count)
-    _Analytics.get().post_event(category='appCode', action='jsLineCount', 
+    analytics.post_event(category='appCode', action='jsLineCount', 
                label=uuid, value = js_line_count)
 
 
@@ -331,15 +457,16 @@ def res_sizes_evt(uuid, resCounts, resSizes):
     """
     totalSize = sum(resSizes.values())
     totalCount = sum(resCounts.values())
-    _Analytics.get().post_event(category='appResources', action='totalSize', 
+    analytics = _Analytics.get()
+    analytics.post_event(category='appResources', action='totalSize', 
                label=uuid, value = totalSize)
-    _Analytics.get().post_event(category='appResources', action='totalCount', 
+    analytics.post_event(category='appResources', action='totalCount', 
                label=uuid, value = totalCount)
     
     for key in resSizes.keys():
-        _Analytics.get().post_event(category='appResources', 
+        analytics.post_event(category='appResources', 
                 action='%sSize' % (key), label=uuid, value = resSizes[key])
-        _Analytics.get().post_event(category='appResources', 
+        analytics.post_event(category='appResources', 
                 action='%sCount' % (key), label=uuid, value = resCounts[key])
         
 def phone_info_evt(phoneInfoStr):
@@ -354,13 +481,14 @@ def phone_info_evt(phoneInfoStr):
     """
     items = phoneInfoStr.split(',')
     
-    _Analytics.get().post_event(category='phone', action='os', 
+    analytics = _Analytics.get()
+    analytics.post_event(category='phone', action='os', 
                label=items[0], value=0)
     if len(items) >= 2:
-        _Analytics.get().post_event(category='phone', action='osVersion', 
+        analytics.post_event(category='phone', action='osVersion', 
                    label=items[1], value=0)
     if len(items) >= 3:
-        _Analytics.get().post_event(category='phone', action='model', 
+        analytics.post_event(category='phone', action='model', 
                    label=items[2], value=0)
 
 
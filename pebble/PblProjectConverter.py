@@ -2,58 +2,98 @@ import json
 import os
 import re
 import shutil
+import uuid
 
+from collections import OrderedDict
 from PblCommand import PblCommand
 from PblProjectCreator import *
 
-def read_c_code(c_file_path):
+# Single line and block comments, stripped in one pass over the file
+C_COMMENT_PATTERN = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
 
-    C_SINGLELINE_COMMENT_PATTERN = '//.*'
-    C_MULTILINE_COMMENT_PATTERN = '/\*.*\*/'
+C_UUID_BYTE_PATTERN = re.compile('0x([0-9A-Fa-f]{2})')
+C_UUID_PATTERN = re.compile('^{\s*' + '\s*,\s*'.join([C_UUID_BYTE_PATTERN.pattern] * 16) + '\s*}$')
 
-    with open(c_file_path, 'r') as f:
-        c_code = f.read()
+C_IDENTIFIER_PATTERN = '[A-Za-z_]\w*'
+C_DEFINE_PATTERN = re.compile('#define\s+('+C_IDENTIFIER_PATTERN+')\s+\(*(.+)\)*\s*')
 
-        c_code = re.sub(C_SINGLELINE_COMMENT_PATTERN, '', c_code)
-        c_code = re.sub(C_MULTILINE_COMMENT_PATTERN, '', c_code)
+C_STRING_PATTERN = re.compile('^"(.*)"$')
 
-        return c_code
+C_LITERAL_PATTERN = '([^,]+|"[^"]*")'
+PBL_APP_INFO_PATTERN = re.compile(
+        'PBL_APP_INFO(?:_SIMPLE)?\(\s*' +
+        '\s*,\s*'.join([C_LITERAL_PATTERN] * 4) +
+        '(?:\s*,\s*' + '\s*,\s*'.join([C_LITERAL_PATTERN] * 3) + ')?' +
+        '\s*\)'
+        )
 
-def convert_c_uuid(c_uuid):
+C_SOURCE_EXTENSIONS = ('.c', '.h')
+
+# (macros, PBL_APP_INFO arguments) found in each project's src/, keyed by
+# project root; cleared whenever a conversion starts
+_project_scans = {}
 
-    C_UUID_BYTE_PATTERN = '0x([0-9A-Fa-f]{2})'
-    C_UUID_PATTERN = '^{\s*' + '\s*,\s*'.join([C_UUID_BYTE_PATTERN] * 16) + '\s*}$'
+def read_c_code(c_file_path):
+
+    with open(c_file_path, 'r') as f:
+        c_code = f.read()
 
-    UUID_FORMAT = "{}{}{}{}-{}{}-{}{}-{}{}-{}{}{}{}{}{}"
+    return C_COMMENT_PATTERN.sub('', c_code)
+
+def scan_project_sources(project_root):
+    """ Return (macros, app_info) for the C sources of a project, where
+    app_info holds the arguments of the first PBL_APP_INFO found, or None.
+    Each file is read and scanned in a single pass over the tree, and later
+    calls during the same conversion reuse the result. """
+
+    scan = _project_scans.get(project_root)
+    if scan is None:
+        macros = {}
+        app_info = None
+        src_path = os.path.join(project_root, 'src')
+        for root, dirnames, filenames in os.walk(src_path):
+            for f in filenames:
+                if not f.endswith(C_SOURCE_EXTENSIONS):
+                    continue
+                c_code = read_c_code(os.path.join(root, f))
+                extract_c_macros_from_code(c_code, macros)
+                if app_info is None:
+                    m = PBL_APP_INFO_PATTERN.search(c_code)
+                    if m:
+                        app_info = m.groups()
+        scan = _project_scans[project_root] = (macros, app_info)
+
+    return scan
+
+def convert_c_uuid(c_uuid):
 
     c_uuid = c_uuid.lower()
-    if re.match(C_UUID_PATTERN, c_uuid):
-        return UUID_FORMAT.format(*re.findall(C_UUID_BYTE_PATTERN, c_uuid))
+    m = C_UUID_PATTERN.match(c_uuid)
+    if m:
+        return str(uuid.UUID(hex=''.join(m.groups())))
     else:
         return c_uuid
 
-def extract_c_macros_from_code(c_code, macros={}):
+def extract_c_macros_from_code(c_code, macros=None):
 
-    C_IDENTIFIER_PATTERN = '[A-Za-z_]\w*'
-    C_DEFINE_PATTERN = '#define\s+('+C_IDENTIFIER_PATTERN+')\s+\(*(.+)\)*\s*'
+    if macros is None:
+        macros = {}
 
-    for m in re.finditer(C_DEFINE_PATTERN, c_code):
+    for m in C_DEFINE_PATTERN.finditer(c_code):
         groups = m.groups()
         macros[groups[0]] = groups[1].strip()
 
-def extract_c_macros_from_project(project_root, macros={}):
-    src_path = os.path.join(project_root, 'src')
-    for root, dirnames, filenames in os.walk(src_path):
-        for f in filenames:
-            file_path = os.path.join(root, f)
-            extract_c_macros_from_code(read_c_code(file_path), macros)
+    return macros
+
+def extract_c_macros_from_project(project_root, macros=None):
+    if macros is None:
+        macros = {}
+    macros.update(scan_project_sources(project_root)[0])
 
     return macros
 
 def convert_c_expr_dict(c_expr_dict, project_root):
 
-    C_STRING_PATTERN = '^"(.*)"$'
-
     macros = extract_c_macros_from_project(project_root)
     for k, v in c_expr_dict.iteritems():
         if v == None:
@@ -64,7 +104,7 @@ def convert_c_expr_dict(c_expr_dict, project_root):
             v = macros[v]
 
         # Format C strings
-        m = re.match(C_STRING_PATTERN, v)
+        m = C_STRING_PATTERN.match(v)
         if m:
             v = m.groups()[0].decode('string-escape')
 
@@ -74,15 +114,6 @@ def convert_c_expr_dict(c_expr_dict, project_root):
 
 def find_pbl_app_info(project_root):
 
-    C_LITERAL_PATTERN = '([^,]+|"[^"]*")'
-
-    PBL_APP_INFO_PATTERN = (
-            'PBL_APP_INFO(?:_SIMPLE)?\(\s*' +
-            '\s*,\s*'.join([C_LITERAL_PATTERN] * 4) +
-            '(?:\s*,\s*' + '\s*,\s*'.join([C_LITERAL_PATTERN] * 3) + ')?' +
-            '\s*\)'
-            )
-
     PBL_APP_INFO_FIELDS = [
             'uuid',
             'project_name',
@@ -93,13 +124,9 @@ def find_pbl_app_info(project_root):
             'type'
             ]
 
-    src_path = os.path.join(project_root, 'src')
-    for root, dirnames, filenames in os.walk(src_path):
-        for f in filenames:
-            file_path = os.path.join(root, f)
-            m = re.search(PBL_APP_INFO_PATTERN, read_c_code(file_path))
-            if m:
-                return dict(zip(PBL_APP_INFO_FIELDS, m.groups()))
+    app_info = scan_project_sources(project_root)[1]
+    if app_info:
+        return dict(zip(PBL_APP_INFO_FIELDS, app_info))
 
 def extract_c_appinfo(project_root):
 
@@ -119,9 +146,9 @@ def extract_c_appinfo(project_root):
         'version_code': version_major,
         'version_label': '{}.{}.0'.format(version_major, version_minor),
         'menu_icon': appinfo_c_def['menu_icon'],
-        'is_watchface': 'true' if appinfo_c_def['type'] == 'APP_INFO_WATCH_FACE' else 'false',
-        'app_keys': '{}',
-        'resources_media': '[]',
+        'is_watchface': appinfo_c_def['type'] == 'APP_INFO_WATCH_FACE',
+        'app_keys': {},
+        'resources_media': [],
     }
 
     return appinfo_json_def
@@ -129,13 +156,10 @@ def extract_c_appinfo(project_root):
 def load_app_keys(js_appinfo_path):
     with open(js_appinfo_path, "r") as f:
         try:
-            app_keys = json.load(f)['app_keys']
+            return json.load(f, object_pairs_hook=OrderedDict)['app_keys']
         except:
             raise Exception("Failed to import app_keys from {} into new appinfo.json".format(js_appinfo_path))
 
-        app_keys = json.dumps(app_keys, indent=2)
-        return re.sub('\s*\n', '\n  ', app_keys)
-
 def load_resources_map(resources_map_path, menu_icon_name=None):
 
     C_RESOURCE_PREFIX = 'RESOURCE_ID_'
@@ -155,15 +179,15 @@ def load_resources_map(resources_map_path, menu_icon_name=None):
 
     with open(resources_map_path, "r") as f:
         try:
-            resources_media = json.load(f)['media']
+            resources_media = json.load(f, object_pairs_hook=OrderedDict)['media']
         except:
             raise Exception("Failed to import {} into appinfo.json".format(resources_map_path))
 
-        resources_media = filter(None, [convert_resources_media_item(item) for item in resources_media])
-        resources_media = json.dumps(resources_media, indent=2)
-        return re.sub('\s*\n', '\n    ', resources_media)
+        return filter(None, [convert_resources_media_item(item) for item in resources_media])
 
 def generate_appinfo_from_old_project(project_root, js_appinfo_path=None, resources_media_path=None):
+    # the sources may have changed since an earlier conversion
+    _project_scans.clear()
     appinfo_json_def = extract_c_appinfo(project_root)
 
     if js_appinfo_path and os.path.exists(js_appinfo_path):
@@ -173,8 +197,7 @@ def generate_appinfo_from_old_project(project_root, js_appinfo_path=None, resour
         menu_icon_name = appinfo_json_def['menu_icon']
         appinfo_json_def['resources_media'] = load_resources_map(resources_media_path, menu_icon_name)
 
-    with open(os.path.join(project_root, "appinfo.json"), "w") as f:
-        f.write(FILE_DUMMY_APPINFO.substitute(**appinfo_json_def))
+    write_appinfo(project_root, appinfo_json_def)
 
 def convert_project():
     project_root = os.getcwd()
@@ -223,7 +246,13 @@ def convert_project():
     if os.path.exists(resources_path):
         try:
             for f in os.listdir(resources_path):
-                shutil.move(os.path.join(resources_path, f), os.path.join('resources', f))
+                src, dst = os.path.join(resources_path, f), os.path.join('resources', f)
+                try:
+                    # Both live in the project, so this is nearly always a
+                    # plain rename; shutil.move covers everything else
+                    os.rename(src, dst)
+                except OSError:
+                    shutil.move(src, dst)
             os.rmdir(resources_path)
         except:
             raise Exception("Could not move all files in {} up one level".format(resources_path))
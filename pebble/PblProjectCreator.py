@@ -1,7 +1,9 @@
+import json
 import os
-import string
 import uuid
 
+from collections import OrderedDict
+
 from PblCommand import PblCommand
 
 class PblProjectCreator(PblCommand):
@@ -39,8 +41,7 @@ class PblProjectCreator(PblCommand):
         appinfo_dummy = DICT_DUMMY_APPINFO.copy()
         appinfo_dummy['uuid'] = str(uuid.uuid4())
         appinfo_dummy['project_name'] = project_name
-        with open(os.path.join(project_root, "appinfo.json"), "w") as f:
-            f.write(FILE_DUMMY_APPINFO.substitute(**appinfo_dummy))
+        write_appinfo(project_root, appinfo_dummy)
 
         # Add .gitignore file
         with open(os.path.join(project_root, ".gitignore"), "w") as f:
@@ -152,29 +153,35 @@ DICT_DUMMY_APPINFO = {
     'company_name': 'MakeAwesomeHappen',
     'version_code': 1,
     'version_label': '1.0.0',
-    'is_watchface': 'false',
-    'app_keys': """{
-    "dummy": 0
-  }""",
-    'resources_media': '[]'
+    'is_watchface': False,
+    'app_keys': {
+        'dummy': 0
+    },
+    'resources_media': []
 }
 
-FILE_DUMMY_APPINFO = string.Template("""{
-  "uuid": "${uuid}",
-  "shortName": "${project_name}",
-  "longName": "${project_name}",
-  "companyName": "${company_name}",
-  "versionCode": ${version_code},
-  "versionLabel": "${version_label}",
-  "watchapp": {
-    "watchface": ${is_watchface}
-  },
-  "appKeys": ${app_keys},
-  "resources": {
-    "media": ${resources_media}
-  }
-}
-""")
+def write_appinfo(project_root, appinfo_def):
+    """Write appinfo.json for a project from a dict shaped like DICT_DUMMY_APPINFO."""
+
+    appinfo = OrderedDict([
+        ('uuid', appinfo_def['uuid']),
+        ('shortName', appinfo_def['project_name']),
+        ('longName', appinfo_def['project_name']),
+        ('companyName', appinfo_def['company_name']),
+        ('versionCode', appinfo_def['version_code']),
+        ('versionLabel', appinfo_def['version_label']),
+        ('watchapp', OrderedDict([
+            ('watchface', appinfo_def['is_watchface'])
+        ])),
+        ('appKeys', appinfo_def['app_keys']),
+        ('resources', OrderedDict([
+            ('media', appinfo_def['resources_media'])
+        ]))
+    ])
+
+    with open(os.path.join(project_root, "appinfo.json"), "w") as f:
+        json.dump(appinfo, f, indent=2, separators=(',', ': '))
+        f.write("\n")
 
 FILE_DUMMY_JAVASCRIPT_SRC = """\
 Pebble.addEventListener("ready",
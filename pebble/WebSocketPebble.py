@@ -1,9 +1,11 @@
 import errno
+import os
+import socket
 import sys
 import logging
-from websocket import *
-from struct import unpack
-from struct import pack
+from websocket import ABNF, WebSocket, WebSocketConnectionClosedException
+from websocket import default_timeout, enableTrace, traceEnabled
+from struct import Struct
 
 # This file contains the libpebble websocket client.
 # Based on websocket.py from:
@@ -17,8 +19,93 @@ WS_CMD_APP_INSTALL = 0x04
 WS_CMD_STATUS = 0x5
 WS_CMD_PHONE_INFO = 0x06
 
+RECV_CHUNK_SIZE = 65536 # bytes asked of the socket each time we run dry
+SEND_COALESCE_SIZE = 8192 # bytes of corked frames held before sending anyway
+SOCKET_BUFFER_SIZE = 1 << 20 # kernel send/receive buffer we ask for
+
+WS_CMD_STRUCT = Struct("!B") # ws_cmd
+WS_STATUS_STRUCT = Struct("I") # status
+MESSAGE_HEADER_STRUCT = Struct("!HH") # length, endpoint
+WS_FRAME_HEADER_STRUCT = Struct("!BB") # fin | opcode, mask | length
+WS_FRAME_LENGTH16_STRUCT = Struct("!H") # extended length
+WS_FRAME_LENGTH64_STRUCT = Struct("!Q") # extended length
+
+class WebSocketConnectError(Exception):
+    """ Raised by create_connection when the phone can't be reached """
+    pass
+
+# str.translate tables XORing every byte with a given mask byte, built on use
+_XOR_TABLES = {}
+
+def _xor_table(key_byte):
+    table = _XOR_TABLES.get(key_byte)
+    if table is None:
+        table = _XOR_TABLES[key_byte] = ''.join(chr(b ^ key_byte) for b in xrange(256))
+    return table
+
+def _mask_in_place(buf, start, mask_key):
+    """
+    XOR buf[start:] with the repeating mask_key. Every fourth byte shares a
+    mask byte, so each of those four lanes is masked with a single
+    translate instead of a byte at a time in Python.
+    """
+    for i in xrange(4):
+        lane = slice(start + i, None, 4)
+        buf[lane] = buf[lane].translate(_xor_table(ord(mask_key[i])))
+
+def _mask(mask_key, data):
+    """
+    Drop-in replacement for ABNF.mask, which XORs the payload one byte at a
+    time in Python.
+    """
+    masked = bytearray(data)
+    _mask_in_place(masked, 0, mask_key)
+    return str(masked)
+
+# Client frames are always masked, so this is the bulk of the cost of
+# sending an app or firmware over the websocket
+ABNF.mask = staticmethod(_mask)
+
+def _log_payload(prefix, data, as_hex=False):
+    """
+    Debug log the payload of a received frame, only slicing and formatting
+    it if debug logging is actually on.
+    """
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        payload = data[1:]
+        logging.debug("%s: %s", prefix, payload.encode("hex") if as_hex else repr(payload))
+
 class WebSocketPebble(WebSocket):
 
+    def __init__(self, *args, **kwargs):
+        WebSocket.__init__(self, *args, **kwargs)
+        self._ws_cmd_handlers = {
+                WS_CMD_SERVER_LOG: self._server_log_response,
+                WS_CMD_PHONE_APP_LOG: self._phone_app_log_response,
+                WS_CMD_PHONE_TO_WATCH: self._phone_to_watch_response,
+                WS_CMD_WATCH_TO_PHONE: self._watch_to_phone_response,
+                WS_CMD_STATUS: self._status_response,
+                WS_CMD_PHONE_INFO: self._phone_info_response,
+        }
+        self._rx_data = ''
+        self._rx_pos = 0
+        self._tx_buf = bytearray()
+        self._corked = False
+
+    def _recv_strict(self, bufsize):
+        """
+        Overrides WebSocket._recv_strict, which recv()s exactly what each
+        piece of a frame needs, several syscalls per frame. Here we take
+        whatever the socket has (up to RECV_CHUNK_SIZE) and hand frames out
+        of that, so a burst of app log frames costs one recv between them.
+        """
+        while len(self._rx_data) - self._rx_pos < bufsize:
+            self._rx_data = self._rx_data[self._rx_pos:] + self._recv(RECV_CHUNK_SIZE)
+            self._rx_pos = 0
+        start = self._rx_pos
+        self._rx_pos += bufsize
+        return self._rx_data[start:self._rx_pos]
+
 ######## libPebble Bridge Methods #########
 
     def write(self, payload, opcode = ABNF.OPCODE_BINARY, ws_cmd = WS_CMD_PHONE_TO_WATCH):
@@ -34,18 +121,65 @@ class WebSocketPebble(WebSocket):
                     log.debug("LightBlue process has shutdown (queue write)")
 
         """
-        # Append command byte to the payload:
-        payload = pack("B", ws_cmd) + payload
-        frame = ABNF.create_frame(payload, opcode)
-        if self.get_mask_key:
-            frame.get_mask_key = self.get_mask_key
-        data = frame.format()
-
-        sent = 0
-        while sent < len(data):
-            sent += self.sock.send(data[sent:])
-            if traceEnabled:
-                logging.debug('send>>> ' + data.encode('hex'))
+        data = self._format_frame(payload, opcode, ws_cmd)
+
+        if traceEnabled:
+            logging.debug('send>>> ' + str(data).encode('hex'))
+        if not self._corked:
+            self.sock.sendall(data)
+            return
+        self._tx_buf += data
+        if len(self._tx_buf) >= SEND_COALESCE_SIZE:
+            self._send_corked()
+
+    def _format_frame(self, payload, opcode, ws_cmd):
+        """
+        Build the masked frame carrying ws_cmd followed by payload. This is
+        what ABNF.create_frame(...).format() produces, but the payload is
+        copied once into a buffer laid out for the whole frame and masked
+        there, rather than copied again for the command byte, the masking
+        and the header.
+        """
+        length = len(payload) + 1
+        if length < 126:
+            header = WS_FRAME_HEADER_STRUCT.pack(0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = (WS_FRAME_HEADER_STRUCT.pack(0x80 | opcode, 0x80 | 126) +
+                      WS_FRAME_LENGTH16_STRUCT.pack(length))
+        else:
+            header = (WS_FRAME_HEADER_STRUCT.pack(0x80 | opcode, 0x80 | 127) +
+                      WS_FRAME_LENGTH64_STRUCT.pack(length))
+        mask_key = (self.get_mask_key or os.urandom)(4)
+
+        start = len(header) + len(mask_key)
+        frame = bytearray(start + length)
+        frame[:start] = header + mask_key
+        frame[start] = ws_cmd
+        frame[start + 1:] = payload
+        _mask_in_place(frame, start, mask_key)
+        return frame
+
+    def cork(self):
+        """
+        Hold back the frames passed to write() until flush() is called (or
+        SEND_COALESCE_SIZE bytes have built up), so that a burst of messages
+        goes out in one send.
+        """
+        self._corked = True
+
+    def flush(self):
+        """
+        Send any frames held back since cork() and go back to sending each
+        frame as it is written.
+        """
+        self._corked = False
+        self._send_corked()
+
+    def _send_corked(self):
+        if self._tx_buf:
+            data = self._tx_buf
+            self._tx_buf = bytearray()
+            self.sock.sendall(data)
 
     def read(self):
         """
@@ -76,29 +210,38 @@ class WebSocketPebble(WebSocket):
             
         """
         opcode, data = self.recv_data()
-        ws_cmd = unpack('!b',data[0])
-        if ws_cmd[0]==WS_CMD_SERVER_LOG:
-            logging.debug("Server: %s" % repr(data[1:]))
-        if ws_cmd[0]==WS_CMD_PHONE_APP_LOG:
-            logging.debug("Log: %s" % repr(data[1:]))
-            return ('ws', 'log', data[1:], data)
-        if ws_cmd[0]==WS_CMD_PHONE_TO_WATCH:
-            logging.debug("Phone ==> Watch: %s" % data[1:].encode("hex"))
-        if ws_cmd[0]==WS_CMD_WATCH_TO_PHONE:
-            logging.debug("Watch ==> Phone: %s" % data[1:].encode("hex"))
-            size, endpoint = unpack("!HH", data[1:5])
-            resp = data[5:]
-            return ('watch', endpoint, resp, data[1:5])
-        if ws_cmd[0]==WS_CMD_STATUS:
-            logging.debug("Status: %s" % repr(data[1:]))
-            status = unpack("I", data[1:5])[0]
-            return ('ws', 'status', status, data[1:5])
-        if ws_cmd[0]==WS_CMD_PHONE_INFO:
-            logging.debug("Phone info: %s" % repr(data[1:]))
-            response = data[1:]
-            return ('ws', 'phoneInfo', response, data)
-        else:
+        handler = self._ws_cmd_handlers.get(ord(data[0]))
+        if handler is None:
             return (None, None, None, data)
+        return handler(data)
+
+    def _server_log_response(self, data):
+        _log_payload("Server", data)
+        return (None, None, None, data)
+
+    def _phone_app_log_response(self, data):
+        _log_payload("Log", data)
+        return ('ws', 'log', data[1:], data)
+
+    def _phone_to_watch_response(self, data):
+        _log_payload("Phone ==> Watch", data, as_hex=True)
+        return (None, None, None, data)
+
+    def _watch_to_phone_response(self, data):
+        _log_payload("Watch ==> Phone", data, as_hex=True)
+        size, endpoint = MESSAGE_HEADER_STRUCT.unpack_from(data, 1)
+        resp = data[5:]
+        return ('watch', endpoint, resp, data[1:5])
+
+    def _status_response(self, data):
+        _log_payload("Status", data)
+        status, = WS_STATUS_STRUCT.unpack_from(data, 1)
+        return ('ws', 'status', status, data[1:5])
+
+    def _phone_info_response(self, data):
+        _log_payload("Phone info", data)
+        response = data[1:]
+        return ('ws', 'phoneInfo', response, data)
 
 
 
@@ -128,30 +271,29 @@ def create_connection(host, port=9000, timeout=None, connect_timeout=None, **opt
 
     url = "ws://{}:{}".format(host, port)
     try:
-        sockopt = options.get("sockopt", ())
+        # Writes are coalesced by cork()/flush() where it matters, so don't
+        # let Nagle hold back the small request frames we wait on replies to,
+        # and give installs room to keep the pipe full. These are applied
+        # first so that any sockopt the caller passes takes precedence.
+        sockopt = ((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                   (socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE),
+                   (socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)) + tuple(options.get("sockopt", ()))
         websock = WebSocketPebble(sockopt=sockopt)
         websock.settimeout(connect_timeout is not None and connect_timeout or default_timeout)
         websock.connect(url, **options)
         websock.settimeout(timeout is not None and timeout or default_timeout)
     except socket.timeout as e:
-        logging.error("Could not connect to phone at {}:{}. Connection timed out".format(host, port))
-        os._exit(-1)
+        raise WebSocketConnectError("Could not connect to phone at {}:{}. Connection timed out".format(host, port))
     except socket.error as e:
         if e.errno == errno.ECONNREFUSED:
-            logging.error("Could not connect to phone at {}:{}. "
+            raise WebSocketConnectError("Could not connect to phone at {}:{}. "
                       "Ensure that 'Developer Connection' is enabled in the Pebble app.".format(host, port))
-            os._exit(-1)
         else:
             raise e
     except WebSocketConnectionClosedException as e:
-        logging.error("Connection was rejected. The Pebble app is already connected to another client.")
-        os._exit(-1)
+        raise WebSocketConnectError("Connection was rejected. The Pebble app is already connected to another client.")
     return websock
 
-_MAX_INTEGER = (1 << 32) -1
-_AVAILABLE_KEY_CHARS = range(0x21, 0x2f + 1) + range(0x3a, 0x7e + 1)
-_MAX_CHAR_BYTE = (1<<8) -1
-
 
 
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import array
 import binascii
 import datetime
 import glob
@@ -7,26 +8,49 @@ import itertools
 import json
 import logging as log
 import os
-import sh
 import signal
 import stm32_crc
 import struct
+import sys
 import threading
 import time
-import traceback
 import re
 import uuid
 import zipfile
 import WebSocketPebble
 
 from collections import OrderedDict
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 from PIL import Image
 
 DEFAULT_PEBBLE_ID = None #Triggers autodetection on unix-like systems
 DEFAULT_WEBSOCKET_PORT = 9000
 DEBUG_PROTOCOL = False
 APP_ELF_PATH = 'build/pebble-app.elf'
+APPBANK_STATUS_TTL = 2 # seconds a cached app bank listing stays valid
+PUTBYTES_TIMEOUT = 60 # seconds a PutBytes transfer may go without hearing from the watch
+PUTBYTES_CHUNK_SIZE = 2000 # payload bytes per PutBytes DATA message; a multiple of 4 so the CRC can be accumulated per chunk
+AUTODETECT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".pebble", "autodetect.json")
+
+ASYNC_LOW_LATENCY = 0x2000 # serial_struct flag, linux/serial.h
+IOSSDATALAT = 0x80085400 # _IOW('T', 0, unsigned long), IOKit/serial/ioss.h
+
+MESSAGE_HEADER_STRUCT = struct.Struct("!HH") # length, endpoint
+APPINFO_STRUCT = struct.Struct("!II32s32sIH") # one app bank entry in an APP_MANAGER listing
+FWVER_STRUCT = struct.Struct("!i32s8s?bb") # one firmware entry in a VERSION response
+HWVER_STRUCT = struct.Struct("!L9s12s") # bootloader timestamp, hardware version, serial
+BTMAC_STRUCT = struct.Struct("6B") # Bluetooth address, least significant byte first
+BTMAC_FORMAT = ":".join(["%02X"] * 6)
+LOG_HEADER_STRUCT = struct.Struct("!IBBH") # timestamp, level, length, line number
+COMMAND_UINT32_STRUCT = struct.Struct("!bL") # command/response type, cookie or timestamp
+PUTBYTES_INIT_STRUCT = struct.Struct("!bIbb") # command, size, transfer type, bank index
+PUTBYTES_DATA_STRUCT = struct.Struct("!bII") # command, token, length (or CRC for commit)
+PUTBYTES_TOKEN_STRUCT = struct.Struct("!bI") # command, token
+RESULT_STRUCT = struct.Struct("!b") # leading command/result byte of a response
+APPBANK_HEADER_STRUCT = struct.Struct("!II") # bank count, number of entries
+APP_BANK_COMMAND_STRUCT = struct.Struct("!bII") # command, app id, bank index
+APP_INDEX_COMMAND_STRUCT = struct.Struct("!bI") # command, bank index
+APP_DESCRIPTION_STRUCT = struct.Struct("H32s32s") # version, name, company
 
 class PebbleBundle(object):
     MANIFEST_FILENAME = 'manifest.json'
@@ -81,9 +105,8 @@ class PebbleBundle(object):
 
         app_manifest = self.get_manifest()['application']
 
-        app_bin = self.zip.open(app_manifest['name']).read()
-
-        header = app_bin[0:self.app_metadata_length_bytes]
+        # only the header is needed, so don't inflate the whole binary
+        header = self.zip.open(app_manifest['name']).read(self.app_metadata_length_bytes)
         values = self.app_metadata_struct.unpack(header)
         self.header = {
                 'sentinel' : values[0],
@@ -200,18 +223,22 @@ class EndpointSync():
 
     def __init__(self, pebble, endpoint):
         self.marker = threading.Event()
-        pebble.register_endpoint(endpoint, self.callback)
+        self.pebble = pebble
+        self.endpoint = pebble.endpoints[endpoint]
+        self.data = None
+        pebble._pending_responses[self.endpoint] = self
 
     def callback(self, endpoint, response):
         self.data = response
         self.marker.set()
 
     def get_data(self):
-        try:
-            self.marker.wait(timeout=self.timeout)
-            return self.data
-        except:
-            raise PebbleError(None, "Timed out... Is the Pebble phone app connected?")
+        if not self.marker.wait(timeout=self.timeout):
+            # only the reader thread removes the entry, so a late reply is
+            # swallowed here rather than reaching the streaming handlers; the
+            # next request for this endpoint replaces it
+            raise PebbleError(self.pebble.id, "Timed out... Is the Pebble phone app connected?")
+        return self.data
 
 class PebbleError(Exception):
     def __init__(self, id, message):
@@ -221,6 +248,9 @@ class PebbleError(Exception):
     def __str__(self):
         return "%s (ID:%s)" % (self._message, self._id)
 
+class PebbleConnectError(PebbleError):
+    pass
+
 class Pebble(object):
 
     """
@@ -261,21 +291,82 @@ class Pebble(object):
 
 
     @staticmethod
-    def AutodetectDevice():
+    def _read_autodetect_cache(dev_mtime):
+        try:
+            with open(AUTODETECT_CACHE_FILE) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cache.get("dev_mtime") != dev_mtime:
+            return None
+        id = cache.get("id")
+        if not id or not os.path.exists("/dev/tty.Pebble{}-SerialPortSe".format(id)):
+            return None
+        return id
+
+    @staticmethod
+    def _write_autodetect_cache(dev_mtime, id):
+        try:
+            cache_dir = os.path.dirname(AUTODETECT_CACHE_FILE)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            with open(AUTODETECT_CACHE_FILE, 'w') as f:
+                json.dump({"dev_mtime": dev_mtime, "id": id}, f)
+        except (IOError, OSError), e:
+            log.debug("Could not save autodetected Pebble: %s" % e)
+
+    @staticmethod
+    def forget_autodetected_device():
+        Pebble.clear_discovery_cache()
+        try:
+            os.remove(AUTODETECT_CACHE_FILE)
+        except OSError:
+            pass
+
+    # device globs and stats shared by every AutodetectDevice call in this
+    # process; long-running callers should clear it when devices change
+    _discovery_cache = {}
+
+    @staticmethod
+    def clear_discovery_cache():
+        Pebble._discovery_cache.clear()
+
+    @staticmethod
+    def AutodetectDevice(_cache = None):
         if os.name != "posix": #i.e. Windows
             raise NotImplementedError("Autodetection is only implemented on UNIX-like systems.")
+        if _cache is None:
+            _cache = Pebble._discovery_cache
+
+        # /dev's mtime changes whenever a device node comes or goes, so a
+        # previous run's answer is good until then
+        dev_mtime = os.stat("/dev").st_mtime
+        id = Pebble._read_autodetect_cache(dev_mtime)
+        if id is not None:
+            log.info("Autodetect found a Pebble with ID %s" % id)
+            return id
 
-        pebbles = glob.glob("/dev/tty.Pebble????-SerialPortSe")
+        if "glob" not in _cache:
+            _cache["glob"] = glob.glob("/dev/tty.Pebble????-SerialPortSe")
+        pebbles = list(_cache["glob"])
 
         if len(pebbles) == 0:
+            # the watch may show up before the next attempt, so don't let
+            # this empty result stand in for a fresh look at /dev
+            _cache.pop("glob", None)
             raise PebbleError(None, "Autodetection could not find any Pebble devices")
         elif len(pebbles) > 1:
             log.warn("Autodetect found %d Pebbles; using most recent" % len(pebbles))
             #NOTE: Not entirely sure if this is the correct approach
-            pebbles.sort(key=lambda x: os.stat(x).st_mtime, reverse=True)
+            mtimes = _cache.setdefault("stat", {})
+            for x in pebbles:
+                if x not in mtimes:
+                    mtimes[x] = os.stat(x).st_mtime
+            pebbles.sort(key=lambda x: mtimes[x], reverse=True)
 
         id = pebbles[0][15:19]
         log.info("Autodetect found a Pebble with ID %s" % id)
+        Pebble._write_autodetect_cache(dev_mtime, id)
         return id
 
 
@@ -287,7 +378,11 @@ class Pebble(object):
         self._read_thread = None
         self._alive = True
         self._ws_client = None
+        self._rxbuf = bytearray()
+        self._appbank_status = None
+        self._appbank_status_time = 0
         self._endpoint_handlers = {}
+        self._pending_responses = {}
         self._internal_endpoint_handlers = {
                 self.endpoints["TIME"]: self._get_time_response,
                 self.endpoints["VERSION"]: self._version_response,
@@ -311,24 +406,54 @@ class Pebble(object):
             self._read_thread.start()
             log.debug("Reader thread loaded on tid %s" % self._read_thread.name)
         except PebbleError:
-            raise PebbleError(id, "Failed to connect to Pebble")
-        except:
-            raise
+            raise PebbleConnectError(self.id, "Failed to connect to Pebble")
 
     def connect_via_serial(self, id = None):
         self._connection_type = 'serial'
 
         if id != None:
             self.id = id
-        if self.id is None:
+        autodetected = self.id is None
+        if autodetected:
             self.id = Pebble.AutodetectDevice()
 
         import serial
         devicefile = "/dev/tty.Pebble{}-SerialPortSe".format(self.id)
         log.debug("Attempting to open %s as Pebble device %s" % (devicefile, self.id))
-        self._ser = serial.Serial(devicefile, 115200, timeout=1)
+        # Block in the kernel until data arrives rather than waking up on a
+        # read timeout; the reader thread dispatches each message to the
+        # registered endpoint callbacks as soon as it is complete.
+        try:
+            self._ser = serial.Serial(devicefile, 115200, timeout=None)
+        except serial.SerialException:
+            if autodetected:
+                Pebble.forget_autodetected_device()
+                self.id = None
+            raise
+        self._enable_serial_low_latency()
         self.init_reader()
 
+    def _enable_serial_low_latency(self):
+        """
+        Ask the serial driver to hand over received bytes immediately instead
+        of batching them on its latency timer, which otherwise adds up to 16ms
+        to every round trip. Not every driver supports this, so failing is fine.
+        """
+        try:
+            import fcntl
+            import termios
+            fd = self._ser.fileno()
+            if sys.platform.startswith('linux'):
+                serial_info = array.array('i', [0] * 32)
+                fcntl.ioctl(fd, termios.TIOCGSERIAL, serial_info, True)
+                serial_info[4] |= ASYNC_LOW_LATENCY
+                fcntl.ioctl(fd, termios.TIOCSSERIAL, serial_info)
+            elif sys.platform == 'darwin':
+                # Receive latency in microseconds
+                fcntl.ioctl(fd, IOSSDATALAT, pack("L", 1))
+        except (ImportError, AttributeError, IOError, OSError) as e:
+            log.debug("Could not enable low latency mode on the serial port: %s" % e)
+
     def connect_via_lightblue(self, pair_first = False):
         self._connection_type = 'lightblue'
 
@@ -341,7 +466,10 @@ class Pebble(object):
         self._connection_type = 'websocket'
 
         WebSocketPebble.enableTrace(False)
-        self._ser = WebSocketPebble.create_connection(host, port, connect_timeout=5)
+        try:
+            self._ser = WebSocketPebble.create_connection(host, port, connect_timeout=5)
+        except WebSocketPebble.WebSocketConnectError, e:
+            raise PebbleConnectError(host, str(e))
         self.init_reader()
 
     def _exit_signal_handler(self, signum, frame):
@@ -368,8 +496,10 @@ class Pebble(object):
 
                 if source == 'ws':
                     if endpoint in ['status', 'phoneInfo']:
-                        # phone -> sdk message
-                        self._ws_client.handle_response(endpoint, resp)
+                        # phone -> sdk message; ignore it if nothing is
+                        # waiting for one
+                        if self._ws_client is not None:
+                            self._ws_client.handle_response(endpoint, resp)
                     elif endpoint == 'log':
                         log.info(resp)
                     continue
@@ -378,12 +508,26 @@ class Pebble(object):
                 if DEBUG_PROTOCOL:
                     log.debug('<< ' + binascii.hexlify(resp))
 
-                if endpoint in self._internal_endpoint_handlers:
-                    resp = self._internal_endpoint_handlers[endpoint](endpoint, resp)
+                handler = self._internal_endpoint_handlers.get(endpoint)
+                if handler is not None:
+                    resp = handler(endpoint, resp)
+                    if resp is None:
+                        continue
+
+                # a synchronous request waiting on this endpoint gets the
+                # reply ahead of any handler registered for streaming use
+                sync = self._pending_responses.pop(endpoint, None)
+                if sync is not None:
+                    sync.callback(endpoint, resp)
+                    continue
 
-                if endpoint in self._endpoint_handlers and resp is not None:
-                    self._endpoint_handlers[endpoint](endpoint, resp)
+                handler = self._endpoint_handlers.get(endpoint)
+                if handler is not None:
+                    handler(endpoint, resp)
         except Exception, e:
+            if not self._alive:
+                # We were disconnected on purpose while blocked in a read
+                return
             print str(e)
             log.error("Lost connection to Pebble")
             self._alive = False
@@ -391,19 +535,30 @@ class Pebble(object):
 
 
     def _pack_message_data(self, lead, parts):
-        pascal = map(lambda x: x[:255], parts)
-        d = pack("b" + reduce(lambda x,y: str(x) + "p" + str(y), map(lambda x: len(x) + 1, pascal)) + "p", lead, *pascal)
-        return d
+        pascal = [part[:255] for part in parts]
+        return pack("b", lead) + "".join([chr(len(part)) + part for part in pascal])
 
     def _build_message(self, endpoint, data):
-        return pack("!HH", len(data), endpoint)+data
+        return MESSAGE_HEADER_STRUCT.pack(len(data), endpoint)+data
 
     def _send_message(self, endpoint, data, callback = None):
         if endpoint not in self.endpoints:
             raise PebbleError(self.id, "Invalid endpoint specified")
 
-        msg = self._build_message(self.endpoints[endpoint], data)
+        self._write_message(self._build_message(self.endpoints[endpoint], data))
 
+    def _send_request(self, endpoint, data, async = False):
+        """
+        Send a message and, unless async is set, wait for the watch's reply
+        on the same endpoint. The reply is claimed before the request goes
+        out so it cannot be missed or handed to another handler.
+        """
+        sync = None if async else EndpointSync(self, endpoint)
+        self._send_message(endpoint, data)
+        if sync is not None:
+            return sync.get_data()
+
+    def _write_message(self, msg):
         if DEBUG_PROTOCOL:
             log.debug('>> ' + binascii.hexlify(msg))
 
@@ -415,24 +570,44 @@ class Pebble(object):
                 source, endpoint, resp, data = self._ser.read()
                 if resp is None:
                     return None, None, None
+                if source == 'ws':
+                    # phone -> sdk messages (status, phoneInfo, log) aren't
+                    # pebble protocol; _reader routes them by source
+                    return source, endpoint, resp
             except TypeError:
                 # the lightblue process has likely shutdown and cannot be read from
                 self.alive = False
                 return None, None, None
         else:
-            data = self._ser.read(4)
-            if len(data) == 0:
-                return (None, None, None)
-            elif len(data) < 4:
-                raise PebbleError(self.id, "Malformed response with length "+str(len(data)))
-            size, endpoint = unpack("!HH", data)
-            resp = self._ser.read(size)
+            header_size = MESSAGE_HEADER_STRUCT.size
+            if not self._fill_rxbuf(header_size):
+                if len(self._rxbuf) == 0:
+                    return (None, None, None)
+                raise PebbleError(self.id, "Malformed response with length "+str(len(self._rxbuf)))
+            size, endpoint = MESSAGE_HEADER_STRUCT.unpack_from(buffer(self._rxbuf))
+            self._fill_rxbuf(header_size + size)
+            data = str(self._rxbuf[:header_size])
+            resp = str(self._rxbuf[header_size:header_size + size])
+            del self._rxbuf[:header_size + size]
         if DEBUG_PROTOCOL:
-            log.debug("Got message for endpoint %s of length %d" % (endpoint, len(resp)))
-            log.debug('<<< ' + (data + resp).encode('hex'))
+            log.debug("Got message for endpoint %s of length %d", endpoint, len(resp))
+            log.debug('<<< ' + binascii.hexlify(data + resp))
 
         return ("serial", endpoint, resp)
 
+    def _fill_rxbuf(self, size):
+        """
+        Read from the serial port until at least size bytes are buffered,
+        taking whatever else the driver already has so that back-to-back
+        messages are picked up without another read.
+        """
+        while len(self._rxbuf) < size:
+            chunk = self._ser.read(max(size - len(self._rxbuf), self._ser.inWaiting()))
+            if len(chunk) == 0:
+                return False
+            self._rxbuf += chunk
+        return True
+
     def register_endpoint(self, endpoint_name, func):
         if endpoint_name not in self.endpoints:
             raise PebbleError(self.id, "Invalid endpoint specified")
@@ -440,6 +615,11 @@ class Pebble(object):
         endpoint = self.endpoints[endpoint_name]
         self._endpoint_handlers[endpoint] = func
 
+    def unregister_endpoint(self, endpoint_name, func):
+        endpoint = self.endpoints[endpoint_name]
+        if self._endpoint_handlers.get(endpoint) == func:
+            del self._endpoint_handlers[endpoint]
+
     def notification_sms(self, sender, body):
 
         """Send a 'SMS Notification' to the displayed on the watch."""
@@ -474,36 +654,33 @@ class Pebble(object):
         (firmware, bootloader, etc) running on the watch.
         """
 
-        self._send_message("VERSION", "\x00")
-
-        if not async:
-            return EndpointSync(self, "VERSION").get_data()
+        return self._send_request("VERSION", "\x00", async)
 
 
     def list_apps_by_uuid(self, async=False):
         data = pack("b", 0x05)
-        self._send_message("APP_MANAGER", data)
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+        return self._send_request("APP_MANAGER", data, async)
 
-    def describe_app_by_uuid(self, uuid, uuid_is_string=True, async = False):
+    @staticmethod
+    def _uuid_bytes(app_uuid, uuid_is_string = True):
+        """
+        Normalise a UUID given as a hex string, a uuid.UUID or 16 raw bytes
+        to the raw bytes used on the wire.
+        """
         if uuid_is_string:
-            uuid = uuid.decode('hex')
-        elif type(uuid) is uuid.UUID:
-            uuid = uuid.bytes
+            return binascii.unhexlify(app_uuid)
+        elif isinstance(app_uuid, uuid.UUID):
+            return app_uuid.bytes
         # else, assume it's a byte array
+        return str(app_uuid)
 
-        data = pack("b", 0x06) + str(uuid)
-        self._send_message("APP_MANAGER", data)
-
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+    def describe_app_by_uuid(self, app_uuid, uuid_is_string=True, async = False):
+        data = pack("b", 0x06) + self._uuid_bytes(app_uuid, uuid_is_string)
+        return self._send_request("APP_MANAGER", data, async)
 
     def current_running_uuid(self, async = False):
         data = pack("b", 0x07)
-        self._send_message("APP_MANAGER", data)
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+        return self._send_request("APP_MANAGER", data, async)
 
 
     def get_appbank_status(self, async = False):
@@ -513,53 +690,53 @@ class Pebble(object):
 
         This is particularly useful when trying to locate a
         free app-bank to use when installing a new watch-app.
+
+        Synchronous results are cached for APPBANK_STATUS_TTL seconds, or
+        until an app is added or removed.
         """
-        self._send_message("APP_MANAGER", "\x01")
+        if not async and self._appbank_status is not None and \
+                time.time() - self._appbank_status_time < APPBANK_STATUS_TTL:
+            return self._appbank_status
+
+        apps = self._send_request("APP_MANAGER", "\x01", async)
 
         if not async:
-            apps = EndpointSync(self, "APP_MANAGER").get_data()
-            return apps if type(apps) is dict else { 'apps': [] }
+            if type(apps) is not dict:
+                return { 'apps': [] }
+            self._appbank_status = apps
+            self._appbank_status_time = time.time()
+            return apps
+
+    def _invalidate_appbank_status(self):
+        self._appbank_status = None
 
     def remove_app(self, appid, index, async=False):
 
         """Remove an installed application from the target app-bank."""
 
-        data = pack("!bII", 2, appid, index)
-        self._send_message("APP_MANAGER", data)
-
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+        data = APP_BANK_COMMAND_STRUCT.pack(2, appid, index)
+        self._invalidate_appbank_status()
+        return self._send_request("APP_MANAGER", data, async)
 
     def remove_app_by_uuid(self, uuid_to_remove, uuid_is_string=True, async = False):
 
         """Remove an installed application by UUID."""
 
-        if uuid_is_string:
-            uuid_to_remove = uuid_to_remove.decode('hex')
-        elif type(uuid_to_remove) is uuid.UUID:
-            uuid_to_remove = uuid_to_remove.bytes
-        # else, assume it's a byte array
-
-        data = pack("b", 0x02) + str(uuid_to_remove)
-        self._send_message("APP_MANAGER", data)
-
-        if not async:
-            return EndpointSync(self, "APP_MANAGER").get_data()
+        data = pack("b", 0x02) + self._uuid_bytes(uuid_to_remove, uuid_is_string)
+        self._invalidate_appbank_status()
+        return self._send_request("APP_MANAGER", data, async)
 
     def get_time(self, async = False):
 
         """Retrieve the time from the Pebble's RTC."""
 
-        self._send_message("TIME", "\x00")
-
-        if not async:
-            return EndpointSync(self, "TIME").get_data()
+        return self._send_request("TIME", "\x00", async)
 
     def set_time(self, timestamp):
 
         """Set the time stored in the target Pebble's RTC."""
 
-        data = pack("!bL", 2, timestamp)
+        data = COMMAND_UINT32_STRUCT.pack(2, timestamp)
         self._send_message("TIME", data)
 
 
@@ -620,27 +797,12 @@ class Pebble(object):
             raise PebbleError(self.id, "All %d app banks are full" % apps["banks"])
         log.debug("Attempting to add app to bank %d of %d" % (first_free, apps["banks"]))
 
-        binary = bundle.zip.read(bundle.get_application_info()['name'])
-        if bundle.has_resources():
-            resources = bundle.zip.read(bundle.get_resources_info()['name'])
-        else:
-            resources = None
-        client = PutBytesClient(self, first_free, "BINARY", binary)
-        self.register_endpoint("PUTBYTES", client.handle_message)
-        client.init()
-        while not client._done and not client._error:
-            pass
-        if client._error:
-            raise PebbleError(self.id, "Failed to send application binary %s/pebble-app.bin" % pbw_path)
+        self._put_bytes_from_zip(bundle.zip, bundle.get_application_info()['name'], first_free, "BINARY",
+                "Failed to send application binary %s/pebble-app.bin" % pbw_path)
 
-        if resources:
-            client = PutBytesClient(self, first_free, "RESOURCES", resources)
-            self.register_endpoint("PUTBYTES", client.handle_message)
-            client.init()
-            while not client._done and not client._error:
-                pass
-            if client._error:
-                raise PebbleError(self.id, "Failed to send application resources %s/app_resources.pbpack" % pbw_path)
+        if bundle.has_resources():
+            self._put_bytes_from_zip(bundle.zip, bundle.get_resources_info()['name'], first_free, "RESOURCES",
+                    "Failed to send application resources %s/app_resources.pbpack" % pbw_path)
 
         time.sleep(2)
         self._add_app(first_free)
@@ -649,6 +811,36 @@ class Pebble(object):
         if launch_on_install:
             self.launcher_message(app_metadata['uuid'].bytes, "RUNNING", uuid_is_string=False)
 
+    def _put_bytes(self, index, transfer_type, data, failure_message, size = None):
+        """
+        Transfer one part of a bundle over PutBytes, blocking until the
+        watch has acknowledged all of it. data is either a string or a
+        file-like object holding size bytes.
+        """
+        client = PutBytesClient(self, index, transfer_type, data, size)
+        self.register_endpoint("PUTBYTES", client.handle_message)
+        try:
+            client.init()
+            if not client.wait():
+                # stop the transfer before data goes away; acks still on
+                # their way in are then ignored
+                client.abort()
+                raise PebbleError(self.id, failure_message)
+        finally:
+            self.unregister_endpoint("PUTBYTES", client.handle_message)
+
+    def _put_bytes_from_zip(self, zip, name, index, transfer_type, failure_message):
+        """
+        Stream a member of a bundle over PutBytes, inflating it a chunk at a
+        time as it is sent rather than holding it all in memory. Empty
+        members are skipped.
+        """
+        size = zip.getinfo(name).file_size
+        if size == 0:
+            return
+        with zip.open(name) as data:
+            self._put_bytes(index, transfer_type, data, failure_message, size)
+
     def install_app(self, pbw_path, launch_on_install=True):
 
         """Install an app bundle (*.pbw) to the target Pebble."""
@@ -662,32 +854,22 @@ class Pebble(object):
 
         """Install a firmware bundle to the target watch."""
 
-        resources = None
         with zipfile.ZipFile(pbz_path) as pbz:
-            binary = pbz.read("tintin_fw.bin")
+            # check everything is there before the watch is put into
+            # firmware update mode
+            pbz.getinfo("tintin_fw.bin")
             if not recovery:
-                resources = pbz.read("system_resources.pbpack")
+                pbz.getinfo("system_resources.pbpack")
 
-        self.system_message("FIRMWARE_START")
-        time.sleep(2)
-
-        if resources:
-            client = PutBytesClient(self, 0, "SYS_RESOURCES", resources)
-            self.register_endpoint("PUTBYTES", client.handle_message)
-            client.init()
-            while not client._done and not client._error:
-                pass
-            if client._error:
-                raise PebbleError(self.id, "Failed to send firmware resources %s/system_resources.pbpack" % pbz_path)
+            self.system_message("FIRMWARE_START")
+            time.sleep(2)
 
+            if not recovery:
+                self._put_bytes_from_zip(pbz, "system_resources.pbpack", 0, "SYS_RESOURCES",
+                        "Failed to send firmware resources %s/system_resources.pbpack" % pbz_path)
 
-        client = PutBytesClient(self, 0, "RECOVERY" if recovery else "FIRMWARE", binary)
-        self.register_endpoint("PUTBYTES", client.handle_message)
-        client.init()
-        while not client._done and not client._error:
-            pass
-        if client._error:
-            raise PebbleError(self.id, "Failed to send firmware binary %s/tintin_fw.bin" % pbz_path)
+            self._put_bytes_from_zip(pbz, "tintin_fw.bin", 0, "RECOVERY" if recovery else "FIRMWARE",
+                    "Failed to send firmware binary %s/tintin_fw.bin" % pbz_path)
 
         self.system_message("FIRMWARE_COMPLETE")
 
@@ -706,29 +888,21 @@ class Pebble(object):
         if key_value not in launcher_key_values:
             raise PebbleError(self.id, "not a valid application message")
 
-        if uuid_is_string:
-            app_uuid = app_uuid.decode('hex')
-        elif type(app_uuid) is uuid.UUID:
-            app_uuid = app_uuid.bytes
-        #else we can assume it's a byte array
-
+        app_uuid = self._uuid_bytes(app_uuid, uuid_is_string)
         amsg = AppMessage()
 
         # build and send a single tuple-sized launcher command
         app_message_tuple = amsg.build_tuple(launcher_keys["RUN_STATE_KEY"], "UINT", launcher_key_values[key_value])
         app_message_dict = amsg.build_dict(app_message_tuple)
         packed_message = amsg.build_message(app_message_dict, "PUSH", app_uuid)
-        self._send_message("LAUNCHER", packed_message)
-
         # wait for either ACK or NACK response
-        if not async:
-            return EndpointSync(self, "LAUNCHER").get_data()
+        return self._send_request("LAUNCHER", packed_message, async)
 
     def app_message_send_tuple(self, app_uuid, key, tuple_datatype, tuple_data):
 
         """  Send a Dictionary with a single tuple to the app corresponding to UUID """
 
-        app_uuid = app_uuid.decode('hex')
+        app_uuid = self._uuid_bytes(app_uuid)
         amsg = AppMessage()
 
         app_message_tuple = amsg.build_tuple(key, tuple_datatype, tuple_data)
@@ -804,11 +978,8 @@ class Pebble(object):
 
         """Send a 'ping' to the watch to test connectivity."""
 
-        data = pack("!bL", 0, cookie)
-        self._send_message("PING", data)
-
-        if not async:
-            return EndpointSync(self, "PING").get_data()
+        data = COMMAND_UINT32_STRUCT.pack(0, cookie)
+        return self._send_request("PING", data, async)
 
     phone_control_commands = {
         "ANSWER" : 1,
@@ -911,30 +1082,31 @@ class Pebble(object):
         self.print_pbl_logs = value
 
     def _add_app(self, index):
-        data = pack("!bI", 3, index)
+        data = APP_INDEX_COMMAND_STRUCT.pack(3, index)
+        self._invalidate_appbank_status()
         self._send_message("APP_MANAGER", data)
 
     def _screenshot_response(self, endpoint, data):
         return data
 
     def _ping_response(self, endpoint, data):
-        restype, retcookie = unpack("!bL", data)
+        restype, retcookie = COMMAND_UINT32_STRUCT.unpack(data)
         return retcookie
 
     def _get_time_response(self, endpoint, data):
-        restype, timestamp = unpack("!bL", data)
+        restype, timestamp = COMMAND_UINT32_STRUCT.unpack(data)
         return timestamp
 
     def _system_message_response(self, endpoint, data):
         if len(data) >= 2:
-            log.info("Got system message %s" % repr(unpack('!bb', data[:2])))
+            log.info("Got system message %r", unpack_from('!bb', data))
         else:
             log.info("Got 'unknown' system message: " + binascii.hexlify(data))
 
     def _parse_log_response(self, log_message_data):
-        timestamp, level, msgsize, linenumber = unpack("!IBBH", log_message_data[:8])
-        filename = log_message_data[8:24].decode('utf-8')
-        message = log_message_data[24:24+msgsize].decode('utf-8')
+        timestamp, level, msgsize, linenumber = LOG_HEADER_STRUCT.unpack_from(log_message_data)
+        filename = log_message_data[8:24].rstrip("\x00").decode('utf-8', 'replace')
+        message = log_message_data[24:24+msgsize].decode('utf-8', 'replace')
 
         str_level = self.log_levels[level] if level in self.log_levels else "?"
 
@@ -948,7 +1120,7 @@ class Pebble(object):
         if self.print_pbl_logs:
             timestamp, str_level, filename, linenumber, message = self._parse_log_response(data)
 
-            log.info("{} {} {} {} {}".format(timestamp, str_level, filename, linenumber, message))
+            log.info("%s %s %s %s %s", timestamp, str_level, filename, linenumber, message)
 
     def _print_crash_message(self, crashed_uuid, crashed_pc, crashed_lr):
         # Read the current projects UUID from it's appinfo.json. If we can't do this or the uuid doesn't match
@@ -982,6 +1154,8 @@ class Pebble(object):
             return
 
 
+        import sh
+
         def print_register(register_name, addr_str):
             if (addr_str[0] == '?') or (int(addr_str, 16) > 0x20000):
                 # We log '???' when the reigster isn't available
@@ -1020,13 +1194,8 @@ class Pebble(object):
             self._print_crash_message(crashed_uuid, m.group(2), m.group(3))
 
     def _appbank_status_response(self, endpoint, data):
-        def unpack_uuid(data):
-            UUID_FORMAT = "{}{}{}{}-{}{}-{}{}-{}{}-{}{}{}{}{}{}"
-            uuid = unpack("!bbbbbbbbbbbbbbbb", data)
-            uuid = ["%02x" % (x & 0xff) for x in uuid]
-            return UUID_FORMAT.format(*uuid)
         apps = {}
-        restype, = unpack("!b", data[0])
+        restype, = RESULT_STRUCT.unpack_from(data)
 
         app_install_message = {
                 0: "app available",
@@ -1035,25 +1204,24 @@ class Pebble(object):
         }
 
         if restype == 1:
-            apps["banks"], apps_installed = unpack("!II", data[1:9])
+            apps["banks"], apps_installed = APPBANK_HEADER_STRUCT.unpack_from(data, 1)
             apps["apps"] = []
 
-            appinfo_size = 78
-            offset = 9
-            for i in xrange(apps_installed):
-                app = {}
-                try:
-                    app["id"], app["index"], app["name"], app["company"], app["flags"], app["version"] = \
-                            unpack("!II32s32sIH", data[offset:offset+appinfo_size])
-                    app["name"] = app["name"].replace("\x00", "")
-                    app["company"] = app["company"].replace("\x00", "")
-                    apps["apps"] += [app]
-                except:
-                    if offset+appinfo_size > len(data):
-                        log.warn("Couldn't load bank %d; remaining data = %s" % (i,repr(data[offset:])))
-                    else:
-                        raise
-                offset += appinfo_size
+            appinfo_size = APPINFO_STRUCT.size
+            complete = min(apps_installed, (len(data) - 9) // appinfo_size)
+            for offset in xrange(9, 9 + complete * appinfo_size, appinfo_size):
+                app_id, index, name, company, flags, version = APPINFO_STRUCT.unpack_from(data, offset)
+                apps["apps"].append({
+                        "id": app_id,
+                        "index": index,
+                        "name": name.rstrip("\x00"),
+                        "company": company.rstrip("\x00"),
+                        "flags": flags,
+                        "version": version
+                })
+            if complete < apps_installed:
+                offset = 9 + complete * appinfo_size
+                log.warn("Couldn't load bank %d; remaining data = %s" % (complete, repr(data[offset:])))
 
             return apps
 
@@ -1069,21 +1237,19 @@ class Pebble(object):
             uuid_size = 16
             offset = 5
             for i in xrange(apps_installed):
-                uuid = unpack_uuid(data[offset:offset+uuid_size])
+                uuids.append(str(uuid.UUID(bytes=data[offset:offset+uuid_size])))
                 offset += uuid_size
-                uuids.append(uuid)
             return uuids
 
         elif restype == 6:
             app = {}
-            app["version"], app["name"], app["company"] = unpack("H32s32s", data[1:])
-            app["name"] = app["name"].replace("\x00", "")
-            app["company"] = app["company"].replace("\x00", "")
+            app["version"], app["name"], app["company"] = APP_DESCRIPTION_STRUCT.unpack_from(data, 1)
+            app["name"] = app["name"].rstrip("\x00")
+            app["company"] = app["company"].rstrip("\x00")
             return app
 
         elif restype == 7:
-            uuid = unpack_uuid(data[1:17])
-            return uuid
+            return str(uuid.UUID(bytes=data[1:17]))
 
         else:
             return restype
@@ -1096,26 +1262,24 @@ class Pebble(object):
 
         resp = {}
         for i in xrange(2):
-            fwver_size = 47
-            offset = i*fwver_size+1
+            offset = i*FWVER_STRUCT.size+1
             fw = {}
             fw["timestamp"],fw["version"],fw["commit"],fw["is_recovery"], \
                     fw["hardware_platform"],fw["metadata_ver"] = \
-                    unpack("!i32s8s?bb", data[offset:offset+fwver_size])
+                    FWVER_STRUCT.unpack_from(data, offset)
 
-            fw["version"] = fw["version"].replace("\x00", "")
-            fw["commit"] = fw["commit"].replace("\x00", "")
+            fw["version"] = fw["version"].rstrip("\x00")
+            fw["commit"] = fw["commit"].rstrip("\x00")
 
             fw_name = fw_names[i]
             resp[fw_name] = fw
 
         resp["bootloader_timestamp"],resp["hw_version"],resp["serial"] = \
-                unpack("!L9s12s", data[95:120])
+                HWVER_STRUCT.unpack_from(data, 95)
 
-        resp["hw_version"] = resp["hw_version"].replace("\x00","")
+        resp["hw_version"] = resp["hw_version"].rstrip("\x00")
 
-        btmac_hex = binascii.hexlify(data[120:126])
-        resp["btmac"] = ":".join([btmac_hex[i:i+2].upper() for i in reversed(xrange(0, 12, 2))])
+        resp["btmac"] = BTMAC_FORMAT % BTMAC_STRUCT.unpack_from(data, 120)[::-1]
 
         return resp
 
@@ -1291,6 +1455,9 @@ class PutBytesClient(object):
             "FAILED": 5
     }
 
+    # DATA messages allowed on the wire ahead of the watch's acks
+    window = 8
+
     transfer_types = {
             "FIRMWARE": 1,
             "RECOVERY": 2,
@@ -1299,49 +1466,137 @@ class PutBytesClient(object):
             "BINARY": 5
     }
 
-    def __init__(self, pebble, index, transfer_type, buffer):
+    def __init__(self, pebble, index, transfer_type, buffer, size = None):
         self._pebble = pebble
         self._state = self.states["NOT_STARTED"]
         self._transfer_type = self.transfer_types[transfer_type]
-        self._buffer = buffer
+        if hasattr(buffer, 'read'):
+            # a file-like object of the given size is streamed: each chunk is
+            # read as it is sent and the CRC is accumulated along the way
+            self._reader = buffer
+            self._buffer = self._view = None
+            self._total = size
+        else:
+            # str() is free for the str zip reads produce, and turns anything
+            # else (bytearray, buffer) into the one type the CRC code expects
+            self._reader = None
+            self._buffer = str(buffer)
+            self._view = memoryview(self._buffer)
+            self._total = len(self._buffer)
+        # a whole framed DATA message is assembled here for every chunk, so
+        # the payload is copied once from the source buffer rather than
+        # being sliced and concatenated onto two headers
+        self._scratch = bytearray(MESSAGE_HEADER_STRUCT.size + PUTBYTES_DATA_STRUCT.size + PUTBYTES_CHUNK_SIZE)
         self._index = index
+        self._token = None
         self._done = False
         self._error = False
+        self._finished = threading.Event()
+        # acks are handled on the reader thread, while a timed out transfer
+        # is aborted from the thread waiting on it
+        self._lock = threading.RLock()
+        self._last_activity = time.time()
+        self._in_flight = 0
+        self._handlers = {
+                self.states["WAIT_FOR_TOKEN"]: self.wait_for_token,
+                self.states["IN_PROGRESS"]: self.in_progress,
+                self.states["COMMIT"]: self.handle_commit,
+                self.states["COMPLETE"]: self.handle_complete
+        }
+
+    def wait(self, timeout=PUTBYTES_TIMEOUT):
+        """
+        Block until the transfer has completed or failed. Returns True only
+        if it completed successfully without the watch going quiet for
+        longer than timeout seconds.
+        """
+        while True:
+            remaining = self._last_activity + timeout - time.time()
+            if remaining <= 0 or self._finished.wait(remaining):
+                break
+        return self._done and not self._error
+
+    def _compute_crc(self):
+        self._crc = stm32_crc.crc32(self._buffer)
 
     def init(self):
-        data = pack("!bIbb", 1, len(self._buffer), self._transfer_type, self._index)
+        if self._reader is not None:
+            self._crc = 0xffffffff
+            self._crc_thread = None
+        else:
+            # the CRC is only needed for the final COMMIT, so work it out while
+            # the data is on the wire instead of stalling once the last ack lands
+            self._crc = None
+            self._crc_thread = threading.Thread(target=self._compute_crc)
+            self._crc_thread.setDaemon(True)
+            self._crc_thread.start()
+        data = PUTBYTES_INIT_STRUCT.pack(1, self._total, self._transfer_type, self._index)
         self._pebble._send_message("PUTBYTES", data)
         self._state = self.states["WAIT_FOR_TOKEN"]
 
     def wait_for_token(self, resp):
-        res, = unpack("!b", resp[0])
+        res, = RESULT_STRUCT.unpack_from(resp)
         if res != 1:
             log.error("init failed with code %d" % res)
             self._error = True
+            self._finished.set()
             return
-        self._token, = unpack("!I", resp[1:])
-        self._left = len(self._buffer)
+        self._token, = unpack_from("!I", resp, 1)
+        self._left = self._total
         self._state = self.states["IN_PROGRESS"]
-        self.send()
+        self.fill_window()
+
+    def fill_window(self):
+        # keep up to window DATA messages outstanding so the watch is never
+        # idle waiting for the next chunk while its ack is on the wire
+        if self._error:
+            return
+        frames = []
+        while self._left > 0 and self._in_flight < self.window:
+            frame = self._next_frame()
+            if frame is None:
+                return
+            frames.append(frame)
+        if not frames:
+            return
+        if self._pebble._connection_type == 'serial':
+            # the serial link is a plain byte stream, so a whole batch can
+            # go out in one write; the other transports want one message
+            # per write
+            self._pebble._write_message("".join(frames))
+        elif self._pebble._connection_type == 'websocket':
+            # one websocket frame per message, but all sent together
+            self._pebble._ser.cork()
+            try:
+                for frame in frames:
+                    self._pebble._write_message(frame)
+            finally:
+                self._pebble._ser.flush()
+        else:
+            for frame in frames:
+                self._pebble._write_message(frame)
 
     def in_progress(self, resp):
-        res, = unpack("!b", resp[0])
+        res, = RESULT_STRUCT.unpack_from(resp)
+        self._in_flight -= 1
         if res != 1:
             self.abort()
             return
         if self._left > 0:
-            self.send()
-            log.debug("Sent %d of %d bytes" % (len(self._buffer)-self._left, len(self._buffer)))
-        else:
+            self.fill_window()
+            log.debug("Sent %d of %d bytes", self._total-self._left, self._total)
+        elif self._in_flight == 0:
             self._state = self.states["COMMIT"]
             self.commit()
 
     def commit(self):
-        data = pack("!bII", 3, self._token & 0xFFFFFFFF, stm32_crc.crc32(self._buffer))
+        if self._crc_thread is not None:
+            self._crc_thread.join()
+        data = PUTBYTES_DATA_STRUCT.pack(3, self._token & 0xFFFFFFFF, self._crc)
         self._pebble._send_message("PUTBYTES", data)
 
     def handle_commit(self, resp):
-        res, = unpack("!b", resp[0])
+        res, = RESULT_STRUCT.unpack_from(resp)
         if res != 1:
             self.abort()
             return
@@ -1349,35 +1604,60 @@ class PutBytesClient(object):
         self.complete()
 
     def complete(self):
-        data = pack("!bI", 5, self._token & 0xFFFFFFFF)
+        data = PUTBYTES_TOKEN_STRUCT.pack(5, self._token & 0xFFFFFFFF)
         self._pebble._send_message("PUTBYTES", data)
 
     def handle_complete(self, resp):
-        res, = unpack("!b", resp[0])
+        res, = RESULT_STRUCT.unpack_from(resp)
         if res != 1:
             self.abort()
             return
         self._done = True
+        # the watch has the data now; don't pin it in memory while the next
+        # part of the bundle is read
+        self._buffer = self._view = None
+        self._finished.set()
 
     def abort(self):
-        msgdata = pack("!bI", 4, self._token & 0xFFFFFFFF)
-        self._pebble._send_message("PUTBYTES", msgdata)
-        self._error = True
-
-    def send(self):
-        datalen =  min(self._left, 2000)
-        rg = len(self._buffer)-self._left
-        msgdata = pack("!bII", 2, self._token & 0xFFFFFFFF, datalen)
-        msgdata += self._buffer[rg:rg+datalen]
-        self._pebble._send_message("PUTBYTES", msgdata)
+        with self._lock:
+            if self._error or self._done:
+                return
+            if self._token is not None:
+                msgdata = PUTBYTES_TOKEN_STRUCT.pack(4, self._token & 0xFFFFFFFF)
+                self._pebble._send_message("PUTBYTES", msgdata)
+            self._state = self.states["FAILED"]
+            self._error = True
+            self._finished.set()
+
+    def _next_frame(self):
+        datalen = min(self._left, PUTBYTES_CHUNK_SIZE)
+        rg = self._total-self._left
+        offset = MESSAGE_HEADER_STRUCT.size + PUTBYTES_DATA_STRUCT.size
+        MESSAGE_HEADER_STRUCT.pack_into(self._scratch, 0, PUTBYTES_DATA_STRUCT.size + datalen,
+                self._pebble.endpoints["PUTBYTES"])
+        PUTBYTES_DATA_STRUCT.pack_into(self._scratch, MESSAGE_HEADER_STRUCT.size,
+                2, self._token & 0xFFFFFFFF, datalen)
+        if self._reader is not None:
+            chunk = self._reader.read(datalen)
+            if len(chunk) != datalen:
+                log.error("Transfer source ended %d bytes early" % (self._left - len(chunk)))
+                self.abort()
+                return None
+            self._crc = stm32_crc.process_buffer(chunk, self._crc)
+            self._scratch[offset:offset+datalen] = chunk
+        else:
+            self._scratch[offset:offset+datalen] = self._view[rg:rg+datalen]
         self._left -= datalen
+        self._in_flight += 1
+        return str(buffer(self._scratch, 0, offset+datalen))
 
     def handle_message(self, endpoint, resp):
-        if self._state == self.states["WAIT_FOR_TOKEN"]:
-            self.wait_for_token(resp)
-        elif self._state == self.states["IN_PROGRESS"]:
-            self.in_progress(resp)
-        elif self._state == self.states["COMMIT"]:
-            self.handle_commit(resp)
-        elif self._state == self.states["COMPLETE"]:
-            self.handle_complete(resp)
+        with self._lock:
+            # acks for DATA messages still in flight when the transfer was
+            # aborted must not put anything else on the wire
+            if self._error:
+                return
+            self._last_activity = time.time()
+            handler = self._handlers.get(self._state)
+            if handler is not None:
+                handler(resp)
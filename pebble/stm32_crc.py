@@ -1,36 +1,79 @@
 import array
+import string
 import sys
+import zlib
 
 CRC_POLY = 0x04C11DB7
 
-def process_word(data, crc=0xffffffff):
-    if (len(data) < 4):
-        d_array = array.array('B', data)
-        for x in range(0, 4 - len(data)):
-            d_array.insert(0,0)
-        d_array.reverse()
-        data = d_array.tostring()
+def _make_table():
+    table = []
+    for i in xrange(256):
+        crc = i << 24
+        for j in xrange(8):
+            if (crc & 0x80000000) != 0:
+                crc = ((crc << 1) ^ CRC_POLY) & 0xffffffff
+            else:
+                crc = (crc << 1) & 0xffffffff
+        table.append(crc)
+    return table
+
+# CRC of every possible top byte, so a word can be folded in 8 bits at a time
+# rather than bit by bit
+CRC_TABLE = _make_table()
+
+# every byte value with its bits in reverse order
+BIT_REVERSE = [int('{:08b}'.format(i)[::-1], 2) for i in xrange(256)]
+BIT_REVERSE_TRANSLATION = string.maketrans(''.join(map(chr, xrange(256))), ''.join(map(chr, BIT_REVERSE)))
+
+def _reverse32(x):
+    return (BIT_REVERSE[x & 0xff] << 24) | (BIT_REVERSE[(x >> 8) & 0xff] << 16) | \
+            (BIT_REVERSE[(x >> 16) & 0xff] << 8) | BIT_REVERSE[x >> 24]
 
-    d = array.array('I', data)[0]
-    crc = crc ^ d
+def _process_buffer_zlib(buf, crc):
+    # The STM32 unit runs a non-reflected CRC-32 over each word most
+    # significant byte first. zlib runs the reflected form of the same
+    # polynomial, so feed it the words byte-swapped with each byte's bits
+    # reversed, undo its final inversion and reverse the bits of the result.
+    whole = len(buf) - len(buf) % 4
+    words = array.array('I', buf[:whole])
+    words.byteswap()
+    data = words.tostring()
+    if whole != len(buf):
+        data += _pad_word(buf[whole:])[::-1]
+    data = data.translate(BIT_REVERSE_TRANSLATION)
+    crc = (zlib.crc32(data, _reverse32(crc) ^ 0xffffffff) & 0xffffffff) ^ 0xffffffff
+    return _reverse32(crc)
 
-    for i in xrange(0, 32):
-        if (crc & 0x80000000) != 0:
-            crc = (crc << 1) ^ CRC_POLY
-        else:
-            crc = (crc << 1)
+def _pad_word(data):
+    # a trailing partial word is byte-reversed and zero padded, matching
+    # what the STM32 hardware unit sees
+    d_array = array.array('B', data)
+    d_array.reverse()
+    return d_array.tostring() + '\0' * (4 - len(data))
 
-    result = crc & 0xffffffff
-    return result
+def _process_words(words, crc):
+    table = CRC_TABLE
+    for d in words:
+        crc ^= d
+        crc = ((crc << 8) & 0xffffffff) ^ table[crc >> 24]
+        crc = ((crc << 8) & 0xffffffff) ^ table[crc >> 24]
+        crc = ((crc << 8) & 0xffffffff) ^ table[crc >> 24]
+        crc = ((crc << 8) & 0xffffffff) ^ table[crc >> 24]
+    return crc
+
+def process_word(data, crc=0xffffffff):
+    if (len(data) < 4):
+        data = _pad_word(data)
+    return _process_words(array.array('I', data[:4]), crc)
 
 def process_buffer(buf, c = 0xffffffff):
-    word_count = len(buf) / 4
-    if (len(buf) % 4 != 0):
-        word_count += 1
+    if sys.byteorder == 'little' and array.array('I').itemsize == 4:
+        return _process_buffer_zlib(buf, c)
 
-    crc = c
-    for i in xrange(0, word_count):
-        crc = process_word(buf[i * 4 : (i + 1) * 4], crc)
+    whole = len(buf) - len(buf) % 4
+    crc = _process_words(array.array('I', buf[:whole]), c)
+    if whole != len(buf):
+        crc = process_word(buf[whole:], crc)
     return crc
 
 def crc32(data):